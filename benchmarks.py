@@ -0,0 +1,606 @@
+"""
+Benchmarks for pyFirmata. Run with ``python benchmarks.py``, see ``--help``
+for the options. ``--json`` writes the results in a form that can be
+compared between releases, ``--trace`` replays a trace recorded with
+:meth:`pyfirmata.Board.start_recording` instead.
+
+Most benchmarks run against :class:`pyfirmata.mockup.MockupSerial`, the
+``*_pty`` ones against a real serial port on a pseudo terminal, so no board
+needs to be connected.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+
+import pyfirmata
+from pyfirmata import mockup, trace, util
+from pyfirmata.boards import BOARDS
+from pyfirmata.util import str_to_two_byte_iter
+
+
+# Weights of the kinds of messages in the synthetic streams, see
+# synthetic_stream
+MIXES = {
+    'analog': {'analog': 1},
+    'digital': {'digital': 1},
+    'sysex': {'sysex': 1},
+    'mixed': {'analog': 90, 'digital': 8, 'string': 2},
+}
+
+
+def synthetic_stream(layout, messages, mix, payload=76, seed=0):
+    """
+    Returns a stream of ``messages`` messages from a board with ``layout``,
+    picked at random with the weights in ``mix``, a dict with any of:
+
+    ``'analog'``
+        Analog messages, from all channels in turn.
+    ``'digital'``
+        Digital messages, each with a random pin of a random port changed.
+    ``'sysex'``
+        Firmware reports (which have a handler) with a name of ``payload``
+        characters.
+    ``'string'``
+        String messages (which don't) of ``payload`` characters.
+    """
+    rng = random.Random(seed)
+    kinds = sorted(mix)
+    weights = [mix[kind] for kind in kinds]
+    analog = len(layout['analog'])
+    ports = (len(layout['digital']) + 7) // 8
+    masks = [0] * ports
+    name = ('StandardFirmata.ino' * (payload // 19 + 1))[:payload]
+    firmware = bytearray([pyfirmata.START_SYSEX, pyfirmata.REPORT_FIRMWARE, 2, 5])
+    firmware += str_to_two_byte_iter(name) + bytearray([pyfirmata.END_SYSEX])
+    string = bytearray([pyfirmata.START_SYSEX, pyfirmata.STRING_DATA])
+    string += str_to_two_byte_iter(name) + bytearray([pyfirmata.END_SYSEX])
+
+    stream = bytearray()
+    for i, kind in enumerate(rng.choices(kinds, weights, k=messages)):
+        if kind == 'analog':
+            value = rng.randrange(1024)
+            stream += bytearray([pyfirmata.ANALOG_MESSAGE + i % analog, value % 128, value >> 7])
+        elif kind == 'digital':
+            port = rng.randrange(ports)
+            masks[port] ^= 1 << rng.randrange(8)
+            stream += bytearray([pyfirmata.DIGITAL_MESSAGE + port, masks[port] % 128,
+                                 masks[port] >> 7])
+        elif kind == 'sysex':
+            stream += firmware
+        else:
+            stream += string
+    return stream
+
+
+def mega_capability_reply():
+    """
+    The capability reply of an Arduino Mega running StandardFirmata, as a
+    list of the modes and resolutions of each pin.
+    """
+    pins = []
+    for pin in range(70):
+        modes = []
+        if pin not in (0, 1):
+            modes += [pyfirmata.INPUT, 1, pyfirmata.OUTPUT, 1]
+        if pin >= 54:
+            modes += [pyfirmata.ANALOG, 10]
+        if 2 <= pin <= 13 or 44 <= pin <= 46:
+            modes += [pyfirmata.PWM, 8]
+        if pin < 54 and pin not in (0, 1):
+            modes += [pyfirmata.SERVO, 14]
+        if pin in (20, 21):
+            modes += [6, 1]  # I2C
+        pins.append(modes + [0x7F])
+    return pins
+
+
+def bench_iterate(board, stream, messages):
+    """
+    Returns the number of messages per second ``board.iterate`` handles for
+    ``stream``.
+    """
+    board.sp.clear()
+    board.sp.write(stream)
+    start = time.perf_counter()
+    while board.sp:
+        board.iterate()
+    return messages / (time.perf_counter() - start)
+
+
+def bench_trace(path, layout=BOARDS['arduino_mega']):
+    """
+    Replays the trace at ``path`` as fast as possible, with all analog pins
+    and digital ports reporting. Returns the number of messages per second
+    handled, and the stats of the board.
+    """
+    board = pyfirmata.Board(trace.ReplaySerial(path, speed=None, paused=True), layout,
+                            setup_timeout=0)
+    for pin in board.analog:
+        pin.reporting = True
+    for port in board.digital_ports:
+        port.reporting = True
+    board.enable_stats()
+    board.sp.play()
+    start = time.perf_counter()
+    while not board.sp.finished:
+        board.iterate()
+    elapsed = time.perf_counter() - start
+    stats = board.stats()
+    return sum(stats['messages'].values()) / elapsed, stats
+
+
+def bench_pin_write(board, writes=100000):
+    """Returns the number of digital ``Pin.write`` calls per second."""
+    pin = board.digital[13]
+    pin.mode = pyfirmata.OUTPUT
+    start = time.perf_counter()
+    for i in range(writes):
+        pin.write(i & 1)
+        if not i % 1000:
+            board.sp.clear()
+    elapsed = time.perf_counter() - start
+    board.sp.clear()
+    return writes / elapsed
+
+
+def bench_layout_memory(board, layouts=100):
+    """
+    Returns the number of bytes a Mega layout (its pins, ports and value
+    table) takes on ``board``.
+    """
+    kept = []
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    for i in range(layouts):
+        board.setup_layout(BOARDS['arduino_mega'])
+        kept.append((board.analog, board.digital_ports, board._values))
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return used / layouts
+
+
+def bench_pin_attributes(board, reads=1000000):
+    """Returns the number of pin attribute reads per second."""
+    pin = board.digital[13]
+    elapsed = min(timeit.repeat('pin.reporting; pin.pin_number; pin._mode; pin.port',
+                                globals={'pin': pin}, number=reads // 4, repeat=5))
+    return reads / elapsed
+
+
+def bench_iterate_pty(layout, stream, messages):
+    """
+    Like :func:`bench_iterate`, but the bytes come in through a pseudo
+    terminal, so every serial read is a real system call.
+    """
+    master, slave = os.openpty()
+    pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0
+    board = pyfirmata.Board(os.ttyname(slave), layout)
+    for pin in board.analog:
+        pin.reporting = True
+    # Mark the end of the stream with a version report
+    stream = stream + bytearray([pyfirmata.REPORT_VERSION, 127, 127])
+    writer = threading.Thread(target=os.write, args=(master, bytes(stream)))
+    start = time.perf_counter()
+    writer.start()
+    while board.firmata_version != (127, 127):
+        board.iterate()
+    elapsed = time.perf_counter() - start
+    writer.join()
+    board.exit()
+    os.close(master)
+    os.close(slave)
+    return messages / elapsed
+
+
+def bench_configure_pty(batched, rounds=200):
+    """
+    Returns the time in seconds it takes to set all pins of a Mega to output
+    and write them, writing to a pseudo terminal.
+    """
+    master, slave = os.openpty()
+    pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0
+    board = pyfirmata.Board(os.ttyname(slave), BOARDS['arduino_mega'])
+    pins = board.digital[2:]
+    done = threading.Event()
+
+    def drain():
+        while not done.is_set():
+            os.read(master, 65536)
+    reader = threading.Thread(target=drain)
+    reader.start()
+
+    start = time.perf_counter()
+    for i in range(rounds):
+        if batched:
+            with board.batch():
+                for pin in pins:
+                    pin.mode = pyfirmata.OUTPUT
+                    pin.write(i % 2)
+        else:
+            for pin in pins:
+                pin.mode = pyfirmata.OUTPUT
+                pin.write(i % 2)
+    elapsed = (time.perf_counter() - start) / rounds
+
+    done.set()
+    board.sp.write(b'\x00')  # wake up the reader
+    reader.join()
+    board.exit()
+    os.close(master)
+    os.close(slave)
+    return elapsed
+
+
+def bench_writer_pty(use_writer, writes=20000):
+    """
+    Returns the time in seconds a digital ``Pin.write`` takes the caller,
+    writing to a pseudo terminal directly or through a writer thread, and the
+    time it takes until everything has been written.
+    """
+    master, slave = os.openpty()
+    pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0
+    board = pyfirmata.Board(os.ttyname(slave), BOARDS['arduino'])
+    pin = board.digital[13]
+    pin.mode = pyfirmata.OUTPUT
+    done = threading.Event()
+
+    def drain():
+        while not done.is_set():
+            os.read(master, 65536)
+    reader = threading.Thread(target=drain)
+    reader.start()
+    if use_writer:
+        board.start_writer()
+
+    start = time.perf_counter()
+    for i in range(writes):
+        pin.write(i & 1)
+    elapsed = time.perf_counter() - start
+    board.flush()
+    total = time.perf_counter() - start
+
+    done.set()
+    board.stop_writer()
+    board.sp.write(b'\x00')  # wake up the reader
+    reader.join()
+    board.exit()
+    os.close(master)
+    os.close(slave)
+    return elapsed / writes, total
+
+
+class PollingIterator(util.Iterator):
+    """The Iterator as it was up to 1.1.0, to compare against."""
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                while self.board.bytes_available():
+                    self.board.iterate()
+                time.sleep(0.001)
+            except (AttributeError, OSError):
+                break
+
+
+def bench_iterator_pty(iterator_class, messages=200):
+    """
+    Returns the median latency in seconds between a message being written to
+    the port and its value showing up on the pin, and the CPU time used per
+    second while the board is idle, for ``iterator_class``.
+    """
+    master, slave = os.openpty()
+    pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0
+    board = pyfirmata.Board(os.ttyname(slave), BOARDS['arduino'])
+    pin = board.analog[0]
+    pin.reporting = True
+    it = iterator_class(board)
+    it.start()
+
+    start_cpu, start = time.process_time(), time.perf_counter()
+    time.sleep(1)
+    idle_cpu = (time.process_time() - start_cpu) / (time.perf_counter() - start)
+
+    random.seed(0)
+    latencies = []
+    for i in range(messages):
+        value = i % 2 * 1023
+        os.write(master, bytes(bytearray([pyfirmata.ANALOG_MESSAGE, value % 128, value >> 7])))
+        start = time.perf_counter()
+        while pin.value != value // 1023:
+            time.sleep(0)
+        latencies.append(time.perf_counter() - start)
+        # Don't send in step with a polling loop
+        time.sleep(random.uniform(0.001, 0.003))
+
+    it.stop()
+    it.join()
+    board.exit()
+    os.close(master)
+    os.close(slave)
+    latencies.sort()
+    return latencies[len(latencies) // 2], idle_cpu
+
+
+def bench_board_group_pty(use_group, boards=100, messages=200):
+    """
+    Returns the median latency in seconds and the CPU time used per second
+    while idle, for ``boards`` boards on pseudo terminals, handled by one
+    :class:`~pyfirmata.util.BoardGroup` or by an Iterator each.
+    """
+    ptys = [os.openpty() for i in range(boards)]
+    pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0
+    board_list = [pyfirmata.Board(os.ttyname(slave), BOARDS['arduino'])
+                  for master, slave in ptys]
+    if use_group:
+        threads = [util.BoardGroup(board_list)]
+    else:
+        threads = [util.Iterator(board) for board in board_list]
+    for thread in threads:
+        thread.start()
+
+    start_cpu, start = time.process_time(), time.perf_counter()
+    time.sleep(1)
+    idle_cpu = (time.process_time() - start_cpu) / (time.perf_counter() - start)
+
+    random.seed(0)
+    latencies = []
+    for i in range(messages):
+        board = random.randrange(boards)
+        version = (i % 100, 1)
+        os.write(ptys[board][0], bytes(bytearray((pyfirmata.REPORT_VERSION,) + version)))
+        start = time.perf_counter()
+        while board_list[board].firmata_version != version:
+            time.sleep(0)
+        latencies.append(time.perf_counter() - start)
+        time.sleep(random.uniform(0.001, 0.003))
+
+    for thread in threads:
+        thread.stop()
+        thread.join()
+    for board in board_list:
+        board.exit()
+    for master, slave in ptys:
+        os.close(master)
+        os.close(slave)
+    latencies.sort()
+    return latencies[len(latencies) // 2], idle_cpu
+
+
+def bench_handlers(board, calls=200000):
+    """
+    Returns the time in seconds the analog and digital message handlers take
+    per call, and the analog one for pins in raw mode.
+    """
+    for pin in board.analog:
+        pin.reporting = True
+    board.digital_ports[1].reporting = True
+    analog = min(timeit.repeat('handle(3, 100, 5)', number=calls, repeat=3,
+                               globals={'handle': board._handle_analog_message}))
+    digital = min(timeit.repeat('handle(1, 85, 0); handle(1, 42, 1)', number=calls // 2,
+                                repeat=3, globals={'handle': board._handle_digital_message}))
+    for pin in board.analog:
+        pin.enable_raw()
+    raw = min(timeit.repeat('handle(3, 100, 5)', number=calls, repeat=3,
+                            globals={'handle': board._handle_analog_message}))
+    for pin in board.analog:
+        pin.disable_raw()
+    return analog / calls, digital / calls, raw / calls
+
+
+def bench_port_write(board, writes=100000):
+    """Returns the number of ``Port.write`` calls per second."""
+    port = board.digital_ports[2]
+    for pin in port.pins:
+        pin.mode = pyfirmata.OUTPUT
+    start = time.perf_counter()
+    for i in range(writes):
+        port.pins[i % 8].value = i & 8
+        port.write()
+        if not i % 1000:
+            board.sp.clear()
+    elapsed = time.perf_counter() - start
+    board.sp.clear()
+    return writes / elapsed
+
+
+def bench_capability(board, rounds=200):
+    """
+    Returns the time in seconds it takes to handle the capability reply of a
+    Mega, and the part of that in ``pin_list_to_board_dict``.
+    """
+    pin_list = mega_capability_reply()
+    data = [byte for pin in pin_list for byte in pin]
+    handler = min(timeit.repeat(lambda: board._handle_report_capability_response(*data),
+                                number=rounds, repeat=3))
+    to_dict = min(timeit.repeat(lambda: util.pin_list_to_board_dict([list(pin)
+                                                                     for pin in pin_list]),
+                                number=rounds, repeat=3))
+    return handler / rounds, to_dict / rounds
+
+
+# Registered benchmarks, see benchmark
+BENCHMARKS = []
+
+
+def benchmark(slow=False):
+    """
+    Registers a function as a benchmark. It's called without arguments, and
+    returns a list of ``(name, value, unit)`` results. ``slow`` ones take
+    seconds rather than milliseconds.
+    """
+    def register(func):
+        BENCHMARKS.append((func, slow))
+        return func
+    return register
+
+
+def mockup_mega():
+    board = mockup.MockupBoard('bench', BOARDS['arduino_mega'])
+    for pin in board.analog:
+        pin.reporting = True
+    for port in board.digital_ports:
+        port.reporting = True
+    return board
+
+
+@benchmark()
+def iterate_mixes():
+    board = mockup_mega()
+    results = []
+    for mix in sorted(MIXES):
+        stream = synthetic_stream(BOARDS['arduino_mega'], 50000, MIXES[mix])
+        results.append(('iterate.{0}'.format(mix), bench_iterate(board, stream, 50000),
+                        'msg/s'))
+    board.enable_stats()
+    stream = synthetic_stream(BOARDS['arduino_mega'], 50000, MIXES['mixed'])
+    results.append(('iterate.mixed.stats', bench_iterate(board, stream, 50000), 'msg/s'))
+    return results
+
+
+@benchmark()
+def iterate_pty():
+    results = []
+    for mix in ('analog', 'mixed'):
+        stream = synthetic_stream(BOARDS['arduino_mega'], 50000, MIXES[mix])
+        results.append(('iterate.{0}.pty'.format(mix),
+                        bench_iterate_pty(BOARDS['arduino_mega'], stream, 50000), 'msg/s'))
+    return results
+
+
+@benchmark()
+def handlers():
+    analog, digital, raw = bench_handlers(mockup_mega())
+    return [('handler.analog', analog * 1e9, 'ns'), ('handler.analog.raw', raw * 1e9, 'ns'),
+            ('handler.digital', digital * 1e9, 'ns')]
+
+
+@benchmark()
+def writes():
+    board = mockup_mega()
+    return [('write.pin', bench_pin_write(board), 'writes/s'),
+            ('write.port', bench_port_write(board), 'writes/s')]
+
+
+@benchmark()
+def capability():
+    handler, to_dict = bench_capability(mockup_mega())
+    return [('capability.handler', handler * 1e6, 'us'),
+            ('capability.pin_list_to_board_dict', to_dict * 1e6, 'us')]
+
+
+@benchmark()
+def pins():
+    # Pins and ports of a real board, the mockup ones are different classes
+    master, slave = os.openpty()
+    pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0
+    board = pyfirmata.Board(os.ttyname(slave), BOARDS['arduino_mega'])
+    results = [('pin.attribute_reads', bench_pin_attributes(board), 'reads/s'),
+               ('pin.layout_memory', bench_layout_memory(board), 'bytes')]
+    board.exit()
+    os.close(master)
+    os.close(slave)
+    return results
+
+
+@benchmark()
+def configure():
+    return [('configure.{0}'.format(batched and 'batched' or 'unbatched'),
+             bench_configure_pty(batched) * 1e6, 'us') for batched in (False, True)]
+
+
+@benchmark()
+def writer():
+    results = []
+    for use_writer in (False, True):
+        per_write, total = bench_writer_pty(use_writer)
+        name = use_writer and 'writer' or 'direct'
+        results += [('write.{0}.call'.format(name), per_write * 1e6, 'us'),
+                    ('write.{0}.total'.format(name), total * 1e3, 'ms')]
+    return results
+
+
+@benchmark(slow=True)
+def iterators():
+    results = []
+    for name, iterator_class in (('polling', PollingIterator), ('blocking', util.Iterator)):
+        latency, idle_cpu = bench_iterator_pty(iterator_class)
+        results += [('iterator.{0}.latency'.format(name), latency * 1e6, 'us'),
+                    ('iterator.{0}.idle_cpu'.format(name), idle_cpu * 100, '%')]
+    return results
+
+
+@benchmark(slow=True)
+def board_group():
+    results = []
+    for name, use_group in (('iterators', False), ('group', True)):
+        latency, idle_cpu = bench_board_group_pty(use_group)
+        results += [('boards100.{0}.latency'.format(name), latency * 1e6, 'us'),
+                    ('boards100.{0}.idle_cpu'.format(name), idle_cpu * 100, '%')]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-k', dest='pattern', default='',
+                        help="only run the benchmarks with this in their name")
+    parser.add_argument('--quick', action='store_true', help="skip the slow benchmarks")
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write the results to FILE as JSON ('-' for stdout)")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare with the results in FILE, written with --json")
+    parser.add_argument('--trace', help="replay a trace instead")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = dict((result['name'], result['value'])
+                            for result in json.load(f)['results'])
+
+    if args.trace:
+        rate, stats = bench_trace(args.trace)
+        print('replay {0}: {1:12,.0f} msg/s'.format(args.trace, rate))
+        for command, count in sorted(stats['messages'].items()):
+            print('  0x{0:02X}: {1:8} messages, {2:6.2f} us per handler call'.format(
+                command, count, stats['handler_time'][command] / count * 1e6))
+        return
+
+    results = []
+    for func, slow in BENCHMARKS:
+        if args.pattern not in func.__name__ or (slow and args.quick):
+            continue
+        for name, value, unit in func():
+            results.append({'name': name, 'value': value, 'unit': unit})
+            if args.json != '-':
+                line = '{0:40} {1:14,.2f} {2:9}'.format(name, value, unit)
+                if baseline.get(name):
+                    line += ' {0:6.2f}x'.format(value / baseline[name])
+                print(line)
+
+    if args.json:
+        report = {
+            'pyfirmata': pyfirmata.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
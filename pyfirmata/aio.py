@@ -0,0 +1,311 @@
+"""
+asyncio support: boards that are driven by an event loop instead of a thread.
+
+A single event loop can run any number of boards, without threads or polling::
+
+    >>> board = await AsyncBoard.open('/dev/ttyACM0')
+    >>> pin = await board.get_pin('a:0:i')
+    >>> value = await pin.read()
+    >>> led = await board.get_pin('d:13:o')
+    >>> await led.write(1)
+
+This needs an event loop that supports ``add_reader``, which rules out the
+proactor loop on Windows.
+"""
+from __future__ import division, unicode_literals
+
+import asyncio
+import errno
+import os
+
+import serial
+
+from . import pyfirmata
+from .pyfirmata import (
+    ANALOG_MAPPING_QUERY, ANALOG_MAPPING_RESPONSE, CAPABILITY_QUERY, CAPABILITY_RESPONSE,
+    QUERY_FIRMWARE, REPORT_FIRMWARE, REPORT_VERSION, Board, Pin, Port
+)
+
+
+class SerialTransport(object):
+    """
+    Non-blocking access to an open serial port from an event loop.
+
+    Incoming data is handed to ``data_received`` as soon as the port is
+    readable. Writes never block: what the OS doesn't take right away is
+    buffered and written whenever the port becomes writable again.
+
+    When the port fails or reaches end of file, like when the board is
+    unplugged, the port is closed and ``connection_lost(exc)`` is called.
+    """
+
+    def __init__(self, sp, loop, data_received, connection_lost=None):
+        self.sp = sp
+        self.port = sp.port
+        self._fd = sp.fileno()
+        self._loop = loop
+        self._data_received = data_received
+        self._connection_lost = connection_lost
+        self._buffer = bytearray()
+        self._drain_waiters = []
+        self._closed = False
+        loop.add_reader(self._fd, self._read_ready)
+
+    def _read_ready(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._lost(e)
+            return
+        if not data:
+            # End of file, the port stays readable, so stop reading it
+            self._lost(IOError("Lost the connection with {0}".format(self.port)))
+            return
+        self._data_received(data)
+
+    def _lost(self, exc):
+        self.close(exc)
+        if self._connection_lost is not None:
+            self._connection_lost(exc)
+
+    def write(self, data):
+        if self._closed:
+            raise IOError("{0} is closed".format(self.port))
+        writing = bool(self._buffer)
+        self._buffer += data
+        if not writing:
+            self._write_ready()
+
+    def _write_ready(self):
+        try:
+            written = os.write(self._fd, self._buffer)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self._lost(e)
+                return
+            written = 0
+        del self._buffer[:written]
+        if self._buffer:
+            self._loop.add_writer(self._fd, self._write_ready)
+        else:
+            self._loop.remove_writer(self._fd)
+            waiters, self._drain_waiters = self._drain_waiters, []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def drain(self):
+        """
+        Returns a future that is done when everything written so far has been
+        handed to the OS.
+        """
+        waiter = self._loop.create_future()
+        if self._closed:
+            waiter.set_exception(IOError("{0} is closed".format(self.port)))
+        elif self._buffer:
+            self._drain_waiters.append(waiter)
+        else:
+            waiter.set_result(None)
+        return waiter
+
+    def close(self, exc=None):
+        """
+        Stops handling the port and closes it. Pending :meth:`drain` futures
+        get ``exc``, or an ``IOError``.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        self.sp.close()
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(exc or IOError("{0} is closed".format(self.port)))
+
+
+class AsyncBoard(Board):
+    """
+    A board driven by the running asyncio event loop. Create it with
+    :meth:`open`, or create it and then ``await board.start()``.
+
+    Its pins are :class:`AsyncPin` instances, whose ``read`` and ``write``
+    return awaitables.
+    """
+
+    def __init__(self, port, layout=None, baudrate=57600, name=None):
+        self._setup_parser()
+        self.sp = serial.Serial(port, baudrate, timeout=0)
+        self.name = name or port
+        self._layout = layout
+        self._waiters = []
+        # Why the connection was lost, see _connection_lost
+        self._lost = None
+
+    @classmethod
+    async def open(cls, *args, **kwargs):
+        """
+        Creates and starts a board. Takes the arguments of the constructor and
+        ``setup_timeout``, which is passed on to :meth:`start`.
+        """
+        setup_timeout = kwargs.pop('setup_timeout', None)
+        board = cls(*args, **kwargs)
+        await board.start(setup_timeout)
+        return board
+
+    async def start(self, setup_timeout=None):
+        """
+        Starts handling the serial port in the running event loop, waits for
+        the firmware to answer, and sets up the layout.
+
+        :arg setup_timeout: Like the one of :class:`Board`.
+        """
+        loop = asyncio.get_event_loop()
+        self.sp = SerialTransport(self.sp, loop, self._data_received, self._connection_lost)
+        if setup_timeout is None:
+            setup_timeout = pyfirmata.BOARD_SETUP_WAIT_TIME
+        if setup_timeout:
+            await self._wait_for_firmata(setup_timeout)
+        if self._layout:
+            self.setup_layout(self._layout)
+        else:
+            await self.auto_setup()
+
+    async def auto_setup(self):
+        """
+        Automatic setup based on Firmata's "Capability Query" and "Analog
+        Mapping Query", see :meth:`Board.auto_setup`.
+        """
+        self.add_cmd_handler(ANALOG_MAPPING_RESPONSE, self._handle_analog_mapping_response)
+        self.add_cmd_handler(CAPABILITY_RESPONSE, self._handle_report_capability_response)
+        self.send_sysex(ANALOG_MAPPING_QUERY, [])
+        self.send_sysex(CAPABILITY_QUERY, [])
+        if not await self._wait_for(lambda: self._layout, pyfirmata.CAPABILITY_QUERY_TIMEOUT):
+            self.sp.close()
+            raise IOError("Board detection failed.")
+        self.setup_layout(self._layout)
+
+    async def _wait_for_firmata(self, timeout):
+        self.add_cmd_handler(REPORT_VERSION, self._handle_report_version)
+        self.add_cmd_handler(REPORT_FIRMWARE, self._handle_report_firmware)
+
+        def answered():
+            return self.firmata_version is not None or self.firmware is not None
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while True:
+            self._write(bytearray([REPORT_VERSION]))
+            self.send_sysex(QUERY_FIRMWARE, [])
+            remaining = deadline - loop.time()
+            if await self._wait_for(answered, min(pyfirmata.BOARD_SETUP_QUERY_INTERVAL,
+                                                  remaining)):
+                return
+            if loop.time() >= deadline:
+                self.sp.close()
+                raise IOError("No Firmata firmware answered on {0} within {1} seconds"
+                              .format(self.sp.port, timeout))
+
+    async def _wait_for(self, condition, timeout=None):
+        """
+        Waits until ``condition()`` is true, checking it whenever data comes
+        in. Returns whether it became true within ``timeout`` seconds (or
+        ever, if ``timeout`` is None).
+        """
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not condition():
+            if self._lost is not None:
+                raise self._lost
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                if deadline is None:
+                    await waiter
+                else:
+                    await asyncio.wait_for(waiter, max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                return bool(condition())
+        return True
+
+    def _data_received(self, data):
+        self._parse(data)
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _connection_lost(self, exc):
+        """Makes everything that waits for data fail with ``exc``."""
+        self._lost = exc
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(exc)
+
+    def iterate(self):
+        raise NotImplementedError("An AsyncBoard handles incoming data by itself")
+
+    def drain(self):
+        """
+        Returns a future that is done when everything written so far has been
+        handed to the OS.
+        """
+        return self.sp.drain()
+
+    async def get_pin(self, pin_def):
+        """
+        Like :meth:`Board.get_pin`, but waits until the messages that set up
+        the pin have been written.
+        """
+        pin = Board.get_pin(self, pin_def)
+        await self.drain()
+        return pin
+
+
+class AsyncPort(Port):
+    """A :class:`Port` on an :class:`AsyncBoard`."""
+    __slots__ = ()
+
+    def write(self):
+        """
+        Set the output pins of the port to the correct state. Returns a future
+        that is done when the message has been written.
+        """
+        Port.write(self)
+        return self.board.drain()
+
+
+class AsyncPin(Pin):
+    """A :class:`Pin` on an :class:`AsyncBoard`."""
+    __slots__ = ()
+
+    async def read(self):
+        """
+        Returns the value of the pin, like :meth:`Pin.read`. If no value has
+        come in yet, this waits for the first one. Pins in raw mode return
+        the raw value, like :meth:`Pin.read_raw`.
+        """
+        if self._raw:
+            await self.board._wait_for(lambda: self._raw_value is not None)
+            return self._raw_value
+        value = Pin.read(self)
+        if value is None:
+            await self.board._wait_for(lambda: self.value is not None)
+            value = self.value
+        return value
+
+    def write(self, value):
+        """
+        Output a voltage from the pin, like :meth:`Pin.write`. Returns a future
+        that is done when the message has been written.
+        """
+        Pin.write(self, value)
+        return self.board.drain()
+
+
+AsyncBoard._port_class = AsyncPort
+AsyncBoard._pin_class = AsyncPin
@@ -1,6 +1,8 @@
 from collections import deque
 
 import pyfirmata
+from pyfirmata.boards import BOARDS
+from pyfirmata.util import from_two_bytes, str_to_two_byte_iter, to_two_bytes
 
 
 class MockupSerial(deque):
@@ -14,12 +16,7 @@ class MockupSerial(deque):
 
     def read(self, count=1):
         if count > 1:
-            val = []
-            for i in range(count):
-                try:
-                    val.append(self.popleft())
-                except IndexError:
-                    break
+            val = [self.popleft() for i in range(min(count, len(self)))]
         else:
             try:
                 val = self.popleft()
@@ -50,7 +47,9 @@ class MockupSerial(deque):
 class MockupBoard(pyfirmata.Board):
 
     def __init__(self, port, layout, values_dict={}):
+        self._setup_parser()
         self.sp = MockupSerial(port, 57600)
+        self.name = port
         self.setup_layout(layout)
         self.values_dict = values_dict
         self.id = 1
@@ -74,6 +73,10 @@ class MockupPort(pyfirmata.Port):
         self.board = board
         self.port_number = port_number
         self.reporting = False
+        self._output_mask = 0
+        self._sent_mask = None
+        self._reported_mask = None
+        self._change_callbacks = ()
 
         self.pins = []
         for i in range(8):
@@ -128,6 +131,322 @@ class MockupPin(pyfirmata.Pin):
         self.value = value
 
 
+class SimulatedSerial(MockupSerial):
+    """
+    A serial port to a simulated board running StandardFirmata, for testing
+    without hardware. Pass it to :class:`~pyfirmata.Board` as the port.
+
+    The board answers the version, firmware, capability, analog mapping and
+    pin state queries, keeps track of pin modes and output values, and
+    reports inputs the way StandardFirmata does: analog inputs every sampling
+    interval, digital ports when they change. Set the inputs with
+    :meth:`set_analog` and :meth:`set_digital`. I2C devices are blocks of
+    registers, added with :meth:`add_i2c_device`.
+
+    Time is virtual, in seconds in ``now``. It only moves on when
+    :meth:`advance` is called, except that reading from the port when there
+    is nothing to read moves it on to the arrival of the next reply to a
+    query. That's what makes setting up a board work without advancing.
+
+    Data takes the time it takes to send it at ``baudrate`` (with 10 bits per
+    byte) both ways, and the board can't report faster than its output gets
+    sent, like a real one whose serial buffer is full.
+
+    :arg layout: The layout of the board, see :mod:`pyfirmata.boards`.
+    """
+
+    # Size of the board's serial output buffer
+    TX_BUFFER_SIZE = 64
+
+    def __init__(self, layout=BOARDS['arduino'], port='simulated', baudrate=57600,
+                 firmware='StandardFirmata.ino', version=(2, 5)):
+        super(SimulatedSerial, self).__init__(port, baudrate)
+        self.layout = layout
+        self.baudrate = baudrate
+        self.firmware = firmware
+        self.version = version
+        self.now = 0.0
+        self._byte_time = 10 / baudrate
+        # Data on its way to the host as (arrival time, data), and the time
+        # the last of it is sent. Replies to queries are counted, they're what
+        # reads wait for.
+        self._sending = deque()
+        self._tx_end = 0.0
+        self._replies = 0
+        # Data from the host that the board hasn't handled yet, and the time
+        # the last of it arrives
+        self._received = bytearray()
+        self._rx_end = 0.0
+        self.i2c_devices = {}
+        self._reset()
+
+    def _reset(self):
+        digital = len(self.layout['digital'])
+        self._pin_count = digital + len(self.layout['analog'])
+        self.modes = [pyfirmata.OUTPUT] * digital + [pyfirmata.ANALOG] * len(self.layout['analog'])
+        # Output values, as written by the host
+        self.values = [0] * self._pin_count
+        self._analog_inputs = [0] * len(self.layout['analog'])
+        self._digital_inputs = [0] * self._pin_count
+        self._analog_reporting = [False] * len(self.layout['analog'])
+        self._port_reporting = [False] * ((self._pin_count + 7) // 8)
+        self._reported_ports = [None] * len(self._port_reporting)
+        self.sampling_interval = 0.019
+        self._last_sample = self._next_sample = self.now
+        # Continuous I2C reads as (address, register, count)
+        self._i2c_reads = []
+
+    def set_analog(self, channel, value):
+        """
+        Sets analog input ``channel`` to ``value``, from 0 to 1023, or to a
+        function that returns the value for a virtual time.
+        """
+        self._analog_inputs[channel] = value
+
+    def set_digital(self, pin, value):
+        """Sets digital input ``pin`` high or low."""
+        self._digital_inputs[pin] = 1 if value else 0
+        self._report_port(pin // 8)
+
+    def add_i2c_device(self, address, registers=None):
+        """
+        Adds an I2C device at ``address`` and returns its registers, a
+        ``bytearray`` of 256 unless ``registers`` are given.
+        """
+        if registers is None:
+            registers = bytearray(256)
+        self.i2c_devices[address] = registers
+        return registers
+
+    def advance(self, seconds):
+        """
+        Moves the clock on by ``seconds``, handling everything the board would
+        have done by then.
+        """
+        self._advance_to(self.now + seconds)
+
+    def _advance_to(self, end):
+        while True:
+            # Host data is handled as soon as it has arrived
+            if self._received and self._rx_end <= min(self._next_sample, end):
+                self.now = max(self.now, self._rx_end)
+                size = len(self._received)
+                self._handle_received()
+                if len(self._received) < size:
+                    continue
+            if self._next_sample > end:
+                break
+            self.now = self._last_sample = max(self.now, self._next_sample)
+            self._sample()
+            # The main loop waits for room in the output buffer
+            buffer_full_until = self._tx_end - self.TX_BUFFER_SIZE * self._byte_time
+            self._next_sample = max(self._last_sample + self.sampling_interval,
+                                    buffer_full_until)
+        self.now = max(self.now, end)
+        self._handle_received()
+        while self._sending and self._sending[0][0] <= self.now:
+            arrival, data, reply = self._sending.popleft()
+            self._replies -= reply
+            self.extend(data)
+
+    def _sample(self):
+        for channel, reporting in enumerate(self._analog_reporting):
+            if reporting:
+                value = self._analog_inputs[channel]
+                if callable(value):
+                    value = value(self.now)
+                value = max(0, min(1023, int(value)))
+                self._send([pyfirmata.ANALOG_MESSAGE + channel % 16, value % 128, value >> 7])
+        for address, register, count in self._i2c_reads:
+            self._send_i2c_reply(address, register, count, reply=False)
+
+    def _send_i2c_reply(self, address, register, count, reply=True):
+        registers = self.i2c_devices[address]
+        start = 0 if register is None else register
+        data = list(to_two_bytes(address))
+        data += to_two_bytes(pyfirmata.I2C_NO_REGISTER if register is None else register)
+        for byte in registers[start:start + count]:
+            data += to_two_bytes(byte)
+        self._send_sysex(pyfirmata.I2C_REPLY, data, reply)
+
+    def _send(self, data, reply=False):
+        self._tx_end = max(self._tx_end, self.now) + len(data) * self._byte_time
+        self._sending.append((self._tx_end, bytearray(data), reply))
+        self._replies += reply
+
+    def _send_sysex(self, command, data, reply=True):
+        self._send([pyfirmata.START_SYSEX, command] + list(data) + [pyfirmata.END_SYSEX], reply)
+
+    def _report_port(self, port):
+        if not self._port_reporting[port]:
+            return
+        mask = 0
+        for pin in range(port * 8, min(port * 8 + 8, self._pin_count)):
+            if self.modes[pin] == pyfirmata.INPUT and self._digital_inputs[pin]:
+                mask |= 1 << (pin % 8)
+        if mask != self._reported_ports[port]:
+            self._reported_ports[port] = mask
+            self._send([pyfirmata.DIGITAL_MESSAGE + port, mask % 128, mask >> 7])
+
+    def write(self, value):
+        """Sends ``value`` to the board."""
+        data = bytearray(value) if hasattr(value, '__iter__') else bytearray([value])
+        self._rx_end = max(self._rx_end, self.now) + len(data) * self._byte_time
+        self._received += data
+
+    def _handle_received(self):
+        """Handles the messages from the host that have arrived."""
+        if not self._received or self._rx_end > self.now:
+            return
+        data, self._received = self._received, bytearray()
+        i = 0
+        while i < len(data):
+            command = data[i]
+            if command == pyfirmata.START_SYSEX:
+                end = data.find(pyfirmata.END_SYSEX, i)
+                if end == -1:
+                    break
+                self._handle_sysex(data[i + 1], data[i + 2:end])
+                i = end + 1
+                continue
+            size = {pyfirmata.REPORT_VERSION: 1, pyfirmata.SYSTEM_RESET: 1,
+                    pyfirmata.SET_PIN_MODE: 3}.get(command)
+            if size is None:
+                size = 3 if command & 0xF0 in (pyfirmata.DIGITAL_MESSAGE,
+                                               pyfirmata.ANALOG_MESSAGE) else 2
+            if command < 0x80:
+                i += 1  # a stray data byte
+                continue
+            if i + size > len(data):
+                break
+            self._handle(command, data[i + 1:i + size])
+            i += size
+        self._received = data[i:] + self._received
+
+    def _handle(self, command, data):
+        channel = command & 0x0F
+        if command == pyfirmata.REPORT_VERSION:
+            self._send([pyfirmata.REPORT_VERSION] + list(self.version), reply=True)
+        elif command == pyfirmata.SYSTEM_RESET:
+            self._reset()
+        elif command == pyfirmata.SET_PIN_MODE:
+            pin, mode = data
+            if pin < self._pin_count:
+                # Like the firmware, a new mode starts from a low output
+                if mode != self.modes[pin]:
+                    self.values[pin] = 0
+                self.modes[pin] = mode
+                self._report_port(pin // 8)
+        elif command & 0xF0 == pyfirmata.DIGITAL_MESSAGE:
+            mask = data[0] | data[1] << 7
+            for pin in range(channel * 8, min(channel * 8 + 8, self._pin_count)):
+                if self.modes[pin] == pyfirmata.OUTPUT:
+                    self.values[pin] = mask >> (pin % 8) & 1
+        elif command & 0xF0 == pyfirmata.ANALOG_MESSAGE:
+            if channel < self._pin_count:
+                self.values[channel] = data[0] | data[1] << 7
+        elif command & 0xF0 == pyfirmata.REPORT_ANALOG:
+            if channel < len(self._analog_reporting):
+                self._analog_reporting[channel] = bool(data[0])
+        elif command & 0xF0 == pyfirmata.REPORT_DIGITAL:
+            if channel < len(self._port_reporting):
+                self._port_reporting[channel] = bool(data[0])
+                self._reported_ports[channel] = None
+                self._report_port(channel)
+
+    def _handle_sysex(self, command, data):
+        digital = len(self.layout['digital'])
+        if command == pyfirmata.QUERY_FIRMWARE:
+            self._send_sysex(pyfirmata.REPORT_FIRMWARE,
+                             list(self.version) + list(str_to_two_byte_iter(self.firmware)))
+        elif command == pyfirmata.CAPABILITY_QUERY:
+            reply = []
+            for pin in range(self._pin_count):
+                if pin < digital and pin in self.layout['disabled']:
+                    reply.append(0x7F)
+                    continue
+                reply += [pyfirmata.INPUT, 1, pyfirmata.OUTPUT, 1]
+                if pin >= digital:
+                    reply += [pyfirmata.ANALOG, 10]
+                if pin in self.layout['pwm']:
+                    reply += [pyfirmata.PWM, 8]
+                if pin < digital:
+                    reply += [pyfirmata.SERVO, 14]
+                reply.append(0x7F)
+            self._send_sysex(pyfirmata.CAPABILITY_RESPONSE, reply)
+        elif command == pyfirmata.ANALOG_MAPPING_QUERY:
+            self._send_sysex(pyfirmata.ANALOG_MAPPING_RESPONSE,
+                             [127] * digital + list(range(len(self.layout['analog']))))
+        elif command == pyfirmata.PIN_STATE_QUERY:
+            pin = data[0]
+            if pin < self._pin_count:
+                state = self.values[pin]
+                if self.modes[pin] == pyfirmata.INPUT:
+                    state = self._digital_inputs[pin]
+                state_bytes = [state & 0x7F]
+                state >>= 7
+                while state:
+                    state_bytes.append(state & 0x7F)
+                    state >>= 7
+                self._send_sysex(pyfirmata.PIN_STATE_RESPONSE,
+                                 [pin, self.modes[pin]] + state_bytes)
+        elif command == pyfirmata.SAMPLING_INTERVAL:
+            self.sampling_interval = max(1, data[0] | data[1] << 7) / 1000
+            # The firmware measures from the last sample
+            self._next_sample = self._last_sample + self.sampling_interval
+        elif command == pyfirmata.EXTENDED_ANALOG:
+            pin, value = data[0], 0
+            for i, byte in enumerate(data[1:]):
+                value |= byte << (7 * i)
+            if pin < self._pin_count:
+                self.values[pin] = value
+        elif command == pyfirmata.I2C_REQUEST:
+            address, mode = data[0], data[1] & 0x18
+            if data[1] & pyfirmata.I2C_10BIT_ADDRESS:
+                address |= (data[1] & 0x07) << 7
+            values = [from_two_bytes(data[i:i + 2]) for i in range(2, len(data) - 1, 2)]
+            if mode == pyfirmata.I2C_STOP_READING:
+                self._i2c_reads = [read for read in self._i2c_reads if read[0] != address]
+            elif address not in self.i2c_devices:
+                return
+            elif mode == pyfirmata.I2C_WRITE:
+                if values:
+                    registers = self.i2c_devices[address]
+                    registers[values[0]:values[0] + len(values) - 1] = bytearray(values[1:])
+            else:
+                register, count = (values[0], values[1]) if len(values) > 1 else (None, values[0])
+                if mode == pyfirmata.I2C_READ:
+                    self._send_i2c_reply(address, register, count)
+                else:
+                    self._i2c_reads.append((address, register, count))
+        elif command == pyfirmata.SERVO_CONFIG:
+            if data and data[0] < self._pin_count:
+                self.modes[data[0]] = pyfirmata.SERVO
+
+    def _deliver_reply(self):
+        """
+        If nothing can be read but a reply is on its way, moves the clock on
+        to when it arrives.
+        """
+        if not self:
+            self._handle_received()
+            if self._received and self._rx_end > self.now:
+                self._advance_to(self._rx_end)
+            if not self and self._replies:
+                for arrival, data, reply in self._sending:
+                    if reply:
+                        self._advance_to(arrival)
+                        break
+
+    def read(self, count=1):
+        self._deliver_reply()
+        return super(SimulatedSerial, self).read(count)
+
+    def inWaiting(self):
+        self._deliver_reply()
+        return len(self)
+
+
 class Iterator(object):
     def __init__(self, *args, **kwargs):
         pass
@@ -1,11 +1,27 @@
 from __future__ import division, unicode_literals
 
 import inspect
+import numbers
+import threading
 import time
+import warnings
+from array import array
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
 
 import serial
 
-from .util import pin_list_to_board_dict, to_two_bytes, two_byte_iter_to_str
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .util import (
+    SampleHistory, Writer, capabilities_to_board_dict, parse_capability_response, to_two_bytes,
+    two_byte_iter_to_str
+)
+from .util import WriteQueueFullError  # NOQA: F401
 
 # Message command bytes (0x80(128) to 0xFF(255)) - straight from Firmata.h
 DIGITAL_MESSAGE = 0x90      # send data for a digital pin
@@ -54,13 +70,46 @@ OUTPUT = 1         # as defined in wiring.h
 ANALOG = 2         # analog pin in analogInput mode
 PWM = 3            # digital pin in PWM output mode
 SERVO = 4          # digital pin in SERVO mode
+SHIFT = 5          # shiftIn/shiftOut mode
+I2C = 6            # pin included in I2C setup
+ONEWIRE = 7        # pin configured for 1-wire
+STEPPER = 8        # pin configured for stepper motor
+ENCODER = 9        # pin configured for rotary encoders
+SERIAL = 10        # pin configured for serial communication
+PULLUP = 11        # enable internal pull-up resistor for pin
+
+# Resolutions in bits of boards that don't report them
+DEFAULT_ANALOG_RESOLUTION = 10
+DEFAULT_PWM_RESOLUTION = 8
+
+# I2C request modes, in bits 3 and 4 of the second byte of an I2C_REQUEST
+I2C_WRITE = 0x00
+I2C_READ = 0x08
+I2C_READ_CONTINUOUSLY = 0x10
+I2C_STOP_READING = 0x18
+I2C_10BIT_ADDRESS = 0x20  # set for 10-bit addresses
+# Register StandardFirmata replies with when no register was given
+I2C_NO_REGISTER = 0xFF
 
 # Pin types
 DIGITAL = OUTPUT   # same as OUTPUT below
 # ANALOG is already defined above
 
-# Time to wait after initializing serial, used in Board.__init__
+# The value of pins that don't have one yet in the board's value table
+NAN = float('nan')
+
+# Maximum time to wait for the firmware to answer after initializing serial,
+# used in Board.__init__
 BOARD_SETUP_WAIT_TIME = 5
+# Interval between version queries while waiting for the firmware
+BOARD_SETUP_QUERY_INTERVAL = 0.1
+# Interval between checks for incoming data while waiting for a reply
+BOARD_POLL_INTERVAL = 0.005
+# Maximum time to wait for the reply to a capability query, used in
+# Board.auto_setup
+CAPABILITY_QUERY_TIMEOUT = 1
+# Number of bytes after which a batch is written out early, see Board.batch
+BATCH_FLUSH_THRESHOLD = 256
 
 
 class PinAlreadyTakenError(Exception):
@@ -75,23 +124,65 @@ class NoInputWarning(RuntimeWarning):
     pass
 
 
+# The normalized values of the raw values of analog pins, by full-scale value,
+# shared by all pins with that resolution. See scale_table.
+_scale_tables = {}
+
+
+def scale_table(max_value):
+    """
+    Returns a tuple with the normalized value, from 0.0 to 1.0 and rounded to
+    4 decimals, of every raw value from 0 to ``max_value``. Tables are made
+    once per ``max_value`` and shared.
+    """
+    table = _scale_tables.get(max_value)
+    if table is None:
+        table = tuple(round(raw / max_value, 4) for raw in range(max_value + 1))
+        _scale_tables[max_value] = table
+    return table
+
+
 class Board(object):
     """The Base class for any board."""
     firmata_version = None
     firmware = None
     firmware_version = None
-    _command_handlers = {}
-    _command = None
-    _stored_data = []
-    _parsing_sysex = False
-
-    def __init__(self, port, layout=None, baudrate=57600, name=None, timeout=None):
-        self.sp = serial.Serial(port, baudrate, timeout=timeout)
-        # Allow 5 secs for Arduino's auto-reset to happen
-        # Alas, Firmata blinks its version before printing it to serial
-        # For 2.3, even 5 seconds might not be enough.
-        # TODO Find a more reliable way to wait until the board is ready
-        self.pass_time(BOARD_SETUP_WAIT_TIME)
+    sampling_interval = None
+    _layout = None
+    _layout_cache = None
+    _cache_key = None
+    _analog_mapping = None
+    _batch = None
+    _writer = None
+    _stats = None
+    _recording = None
+
+    def __init__(self, port, layout=None, baudrate=57600, name=None, timeout=None,
+                 setup_timeout=None, layout_cache=None):
+        """
+        :arg port: The name of the serial port, or an open serial port (or
+            anything that acts like one, like a
+            :class:`~pyfirmata.trace.ReplaySerial`).
+        :arg setup_timeout: Maximum number of seconds to wait for the firmware
+            to answer after opening the port, defaults to
+            ``BOARD_SETUP_WAIT_TIME``. The board is ready as soon as it
+            answers, and an ``IOError`` is raised if it never does. Pass ``0``
+            to skip waiting altogether.
+        :arg layout_cache: A :class:`~pyfirmata.util.LayoutCache`. Without a
+            ``layout``, the board is set up from the layout cached for its
+            firmware and port if there is one, see :meth:`auto_setup`.
+        """
+        self._layout_cache = layout_cache
+        self._setup_parser()
+        if hasattr(port, 'read'):
+            self.sp = port
+            port = self.sp.port
+        else:
+            self.sp = serial.Serial(port, baudrate, timeout=timeout)
+        if setup_timeout is None:
+            setup_timeout = BOARD_SETUP_WAIT_TIME
+        if setup_timeout:
+            self._wait_for_firmata(setup_timeout)
         self.name = name
         self._layout = layout
         if not self.name:
@@ -105,8 +196,6 @@ class Board(object):
         # Iterate over the first messages to get firmware data
         while self.bytes_available():
             self.iterate()
-        # TODO Test whether we got a firmware name and version, otherwise there
-        # probably isn't any Firmata installed
 
     def __str__(self):
         return "Board{0.name} on {0.sp.port}".format(self)
@@ -119,32 +208,157 @@ class Board(object):
         """
         self.exit()
 
+    @contextmanager
+    def batch(self, threshold=None):
+        """
+        Collects everything that is written to the board within the ``with``
+        block, and writes it in one go when the block is left. Writes many
+        small messages, like setting up a lot of pins, in one system call
+        (and USB transfer) instead of one each::
+
+            with board.batch():
+                for pin in board.digital[2:]:
+                    pin.mode = OUTPUT
+
+        :arg threshold: When this many bytes have been collected they are
+            written right away, defaults to ``BATCH_FLUSH_THRESHOLD``.
+
+        A batch within a batch is part of the outer one.
+        """
+        if self._batch is not None:
+            yield
+            return
+        self._batch = bytearray()
+        self._batch_threshold = threshold or BATCH_FLUSH_THRESHOLD
+        try:
+            yield
+        finally:
+            batch, self._batch = self._batch, None
+            if batch:
+                (self.sp if self._writer is None else self._writer).write(batch)
+
+    def _write(self, msg):
+        """
+        Writes ``msg`` to the board, hands it to the writer thread, or adds it
+        to the current batch.
+        """
+        if self._batch is None:
+            (self.sp if self._writer is None else self._writer).write(msg)
+            return
+        self._batch += msg
+        if len(self._batch) >= self._batch_threshold:
+            (self.sp if self._writer is None else self._writer).write(self._batch)
+            self._batch = bytearray()
+
+    def start_writer(self, size=1024, overflow='block'):
+        """
+        Starts a thread that does the writing to the serial port from now on,
+        see :class:`~pyfirmata.util.Writer` for the arguments. Writing to the
+        board then returns right away, and is safe to do from several threads
+        at once. (Batches are not, keep each to one thread.)
+        """
+        if self._writer is None:
+            self._writer = Writer(self.sp, size, overflow)
+            self._writer.start()
+
+    def stop_writer(self):
+        """
+        Stops the writer thread once everything it has queued has been
+        written, and goes back to writing directly.
+        """
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.stop()
+            writer.join()
+
+    def flush(self, timeout=None):
+        """
+        Waits until the writer thread has written everything queued so far,
+        or ``timeout`` seconds have passed. Returns whether it did.
+        """
+        if self._writer is None:
+            return True
+        return self._writer.flush(timeout)
+
+    def start_recording(self, file):
+        """
+        Starts recording everything that is read from the board to ``file``,
+        a path or a binary file object, as a trace that can be played back
+        with :class:`~pyfirmata.trace.ReplaySerial`. Doesn't work for an
+        :class:`~pyfirmata.aio.AsyncBoard`.
+        """
+        from .trace import RecordingSerial, TraceWriter  # prevent a circular import
+
+        self.stop_recording()
+        self.sp = self._recording = RecordingSerial(self.sp, TraceWriter(file))
+
+    def stop_recording(self):
+        """Stops recording, and closes the trace."""
+        recording, self._recording = self._recording, None
+        if recording is not None:
+            self.sp = recording.sp
+            recording.trace.close()
+
     def send_as_two_bytes(self, val):
-        self.sp.write(bytearray([val % 128, val >> 7]))
+        self._write(bytearray([val % 128, val >> 7]))
 
     def setup_layout(self, board_layout):
         """
         Setup the Pin instances based on the given board layout.
         """
+        # The values of all pins, the analog ones first. The pins read and
+        # write their values here, see Pin.value.
+        self._values = array('d')
+        self._values_lock = threading.RLock()
+
         # Create pin instances based on board layout
         self.analog = []
         for i in board_layout['analog']:
-            self.analog.append(Pin(self, i))
+            self.analog.append(self._pin_class(self, i))
+
+        # Lookup tables between analog channels and the pins the firmware
+        # numbers them as. Without the analog mapping in the layout, the
+        # analog pins come right after the digital ones.
+        analog_pins = board_layout.get('analog_pins') or [
+            len(board_layout['digital']) + channel for channel in board_layout['analog']]
+        self.analog_pins = dict(zip(board_layout['analog'], analog_pins))
+        self.analog_channels = dict((pin, channel) for channel, pin in self.analog_pins.items())
+        self._analog_by_channel = [None] * (max(board_layout['analog'] or [-1]) + 1)
+        for pin in self.analog:
+            self._analog_by_channel[pin.pin_number] = pin
 
         self.digital = []
         self.digital_ports = []
         for i in range(0, len(board_layout['digital']), 8):
             num_pins = len(board_layout['digital'][i:i + 8])
             port_number = int(i / 8)
-            self.digital_ports.append(Port(self, port_number, num_pins))
+            self.digital_ports.append(self._port_class(self, port_number, num_pins))
 
         # Allow to access the Pin instances directly
         for port in self.digital_ports:
             self.digital += port.pins
 
-        # Setup PWM pins
+        # Setup PWM pins, there is no digital pin for the PWM of an analog pin
         for i in board_layout['pwm']:
-            self.digital[i].PWM_CAPABLE = True
+            if i < len(self.digital):
+                self.digital[i].PWM_CAPABLE = True
+
+        # The modes and resolutions of every pin by the pin number of the
+        # firmware, as {mode: resolution} dicts, if the board reported them.
+        # They set the scale of the values of the pins.
+        self.capabilities = None
+        if board_layout.get('capabilities'):
+            self.capabilities = [dict(zip(modes[::2], modes[1::2]))
+                                 for modes in board_layout['capabilities']]
+        # Layouts where the pins don't match the capabilities (guessed analog
+        # pins, hand-written layouts) get the default resolutions
+        for pin in self.analog:
+            bits = self.resolution(self.analog_pins[pin.pin_number], ANALOG)
+            pin._set_resolution(bits or DEFAULT_ANALOG_RESOLUTION)
+        for pin in self.digital:
+            if pin.PWM_CAPABLE:
+                bits = self.resolution(pin.pin_number, PWM)
+                pin._set_resolution(bits or DEFAULT_PWM_RESOLUTION)
 
         # Disable certain ports like Rx/Tx and crystal ports
         for i in board_layout['disabled']:
@@ -156,42 +370,157 @@ class Board(object):
 
         self._set_default_handlers()
 
+    def resolution(self, pin_number, mode):
+        """
+        Returns the resolution in bits of the pin with the firmware's
+        ``pin_number`` in ``mode``, or None if it doesn't support the mode.
+        Without the capabilities of the board, analog inputs are 10 bits and
+        PWM outputs 8.
+        """
+        if self.capabilities is None:
+            return {ANALOG: DEFAULT_ANALOG_RESOLUTION, PWM: DEFAULT_PWM_RESOLUTION}.get(mode)
+        if pin_number >= len(self.capabilities):
+            return None
+        return self.capabilities[pin_number].get(mode)
+
+    def _wait_for_firmata(self, timeout):
+        """
+        Waits until the firmware answers a version query, which happens as
+        soon as the board is done resetting after the port has been opened.
+        Queries are repeated until an answer comes in, or ``timeout`` seconds
+        have passed, in which case an ``IOError`` is raised.
+        """
+        self.add_cmd_handler(REPORT_VERSION, self._handle_report_version)
+        self.add_cmd_handler(REPORT_FIRMWARE, self._handle_report_firmware)
+
+        def answered():
+            return self.firmata_version is not None or self.firmware is not None
+
+        deadline = time.monotonic() + timeout
+        while True:
+            self._write(bytearray([REPORT_VERSION]))
+            self.send_sysex(QUERY_FIRMWARE, [])
+            remaining = deadline - time.monotonic()
+            if self._wait_for(answered, min(BOARD_SETUP_QUERY_INTERVAL, remaining)):
+                return
+            if time.monotonic() >= deadline:
+                self.sp.close()
+                raise IOError("No Firmata firmware answered on {0} within {1} seconds"
+                              .format(self.sp.port, timeout))
+
+    def _wait_for(self, condition, timeout):
+        """
+        Handles incoming data until ``condition()`` is true. Returns whether it
+        became true within ``timeout`` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            while self.bytes_available():
+                self.iterate()
+            if condition():
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(BOARD_POLL_INTERVAL)
+
+    def _setup_parser(self):
+        """Gives the board its own command handlers and parser state."""
+        # Handler and number of data bytes needed for every command byte, see
+        # add_cmd_handler
+        self._command_handlers = [None] * 256
+        self._command = None
+        self._stored_data = []
+        self._parsing_sysex = False
+        # Incoming bytes that weren't part of a message with a handler
+        self._dropped_bytes = 0
+        # Outstanding I2C reads and continuous reads by (address, register),
+        # see _handle_i2c_reply
+        self._i2c_reads = {}
+        self._i2c_streams = {}
+
     def _set_default_handlers(self):
         # Setup default handlers for standard incoming commands
         self.add_cmd_handler(ANALOG_MESSAGE, self._handle_analog_message)
         self.add_cmd_handler(DIGITAL_MESSAGE, self._handle_digital_message)
         self.add_cmd_handler(REPORT_VERSION, self._handle_report_version)
         self.add_cmd_handler(REPORT_FIRMWARE, self._handle_report_firmware)
+        self.add_cmd_handler(I2C_REPLY, self._handle_i2c_reply)
 
     def auto_setup(self):
         """
-        Automatic setup based on Firmata's "Capability Query"
+        Automatic setup based on Firmata's "Capability Query", and its
+        "Analog Mapping Query" to tell which pins the analog channels are on.
+
+        If the board has a layout cache and a layout is cached for it, the
+        board is set up from that right away. The query is still sent to check
+        the cached layout, and its reply is handled like any other message: if
+        the layout turns out to have changed, the cache is updated and a
+        warning is issued.
         """
+        self.add_cmd_handler(ANALOG_MAPPING_RESPONSE, self._handle_analog_mapping_response)
         self.add_cmd_handler(CAPABILITY_RESPONSE, self._handle_report_capability_response)
+        # The cache key needs the firmware, which is only asked for while
+        # waiting for the board
+        ask_firmware = self._layout_cache is not None and self.firmware is None
+        if ask_firmware:
+            self.add_cmd_handler(REPORT_FIRMWARE, self._handle_report_firmware)
+            self.send_sysex(QUERY_FIRMWARE, [])
+        # The mapping is asked for first, so it's there when the capabilities
+        # are handled. Firmware that doesn't know the query doesn't answer.
+        self.send_sysex(ANALOG_MAPPING_QUERY, [])
         self.send_sysex(CAPABILITY_QUERY, [])
-        self.pass_time(0.1)  # Serial SYNC
 
-        while self.bytes_available():
-            self.iterate()
+        if ask_firmware:
+            self._wait_for(lambda: self.firmware is not None, CAPABILITY_QUERY_TIMEOUT)
+        # Worked out once here, the capability handler mustn't wait for it
+        self._cache_key = self._layout_cache_key()
+        if self._cache_key and self._layout is None:
+            self._layout = self._layout_cache.get(self._cache_key)
+            if self._layout:
+                self.setup_layout(self._layout)
+                return
 
         # handle_report_capability_response will write self._layout
-        if self._layout:
-            self.setup_layout(self._layout)
-        else:
+        if not self._wait_for(lambda: self._layout is not None, CAPABILITY_QUERY_TIMEOUT):
             raise IOError("Board detection failed.")
+        if self._cache_key:
+            self._layout_cache.store(self._cache_key, self._layout)
+        self.setup_layout(self._layout)
+
+    def _layout_cache_key(self):
+        """
+        Returns the key of this board in its layout cache, or None if it
+        doesn't have a cache or the firmware is unknown.
+        """
+        if self._layout_cache is None or self.firmware is None:
+            return None
+        return self._layout_cache.key(self.sp.port, self.firmware, self.firmware_version)
+
+    def invalidate_layout_cache(self):
+        """Forgets the layout cached for this board."""
+        cache_key = self._layout_cache_key()
+        if cache_key:
+            self._layout_cache.invalidate(cache_key)
 
     def add_cmd_handler(self, cmd, func):
-        """Adds a command handler for a command."""
-        len_args = len(inspect.getfullargspec(func)[0])
-
-        def add_meta(f):
-            def decorator(*args, **kwargs):
-                f(*args, **kwargs)
-            decorator.bytes_needed = len_args - 1  # exclude self
-            decorator.__name__ = f.__name__
-            return decorator
-        func = add_meta(func)
-        self._command_handlers[cmd] = func
+        """
+        Adds a command handler for a command. The handler is called with the
+        data bytes of a message: as many as it takes positional arguments, or
+        all of them for a sysex command. For the commands that carry channel
+        data, the channel (a pin or port number) is passed first.
+        """
+        parameters = inspect.signature(func).parameters.values()
+        bytes_needed = len([p for p in parameters
+                            if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)])
+        if self._stats is not None:
+            func = self._timed_handler(cmd, func)
+        if 0x80 <= cmd < START_SYSEX:
+            # Look up channel commands by their first byte, channel included
+            cmd &= 0xF0
+            for byte in range(cmd, cmd + 0x10):
+                self._command_handlers[byte] = (func, bytes_needed)
+        else:
+            self._command_handlers[cmd] = (func, bytes_needed)
 
     def get_pin(self, pin_def):
         """
@@ -212,9 +541,10 @@ class Board(object):
         else:
             bits = pin_def.split(':')
         a_d = bits[0] == 'a' and 'analog' or 'digital'
-        part = getattr(self, a_d)
+        # Analog pins go by channel
+        part = self._analog_by_channel if a_d == 'analog' else self.digital
         pin_nr = int(bits[1])
-        if pin_nr >= len(part):
+        if pin_nr >= len(part) or part[pin_nr] is None:
             raise InvalidPinDefError('Invalid pin definition: {0} at position 3 on {1}'
                                      .format(pin_def, self.name))
         if getattr(part[pin_nr], 'mode', None) == UNAVAILABLE:
@@ -239,10 +569,8 @@ class Board(object):
         return pin
 
     def pass_time(self, t):
-        """Non-blocking time-out for ``t`` seconds."""
-        cont = time.time() + t
-        while time.time() < cont:
-            time.sleep(0)
+        """Sleeps for ``t`` seconds."""
+        time.sleep(t)
 
     def send_sysex(self, sysex_cmd, data):
         """
@@ -254,7 +582,7 @@ class Board(object):
         msg = bytearray([START_SYSEX, sysex_cmd])
         msg.extend(data)
         msg.append(END_SYSEX)
-        self.sp.write(msg)
+        self._write(msg)
 
     def bytes_available(self):
         return self.sp.inWaiting()
@@ -264,43 +592,117 @@ class Board(object):
         Reads and handles data from the microcontroller over the serial port.
         This method should be called in a main loop or in an :class:`Iterator`
         instance to keep this boards pin values up to date.
+
+        Everything that is waiting on the serial port is read in one go and
+        fed to the message parser. Messages that are only partially received
+        are kept and completed on the next call. If nothing is waiting, this
+        blocks until a byte arrives or the serial timeout passes.
+
+        Returns the number of bytes read.
         """
-        byte = self.sp.read()
-        if not byte:
-            return
-        data = ord(byte)
-        received_data = []
-        handler = None
-        if data < START_SYSEX:
-            # These commands can have 'channel data' like a pin nummber appended.
-            try:
-                handler = self._command_handlers[data & 0xF0]
-            except KeyError:
-                return
-            received_data.append(data & 0x0F)
-            while len(received_data) < handler.bytes_needed:
-                received_data.append(ord(self.sp.read()))
-        elif data == START_SYSEX:
-            data = ord(self.sp.read())
-            handler = self._command_handlers.get(data)
-            if not handler:
-                return
-            data = ord(self.sp.read())
-            while data != END_SYSEX:
-                received_data.append(data)
-                data = ord(self.sp.read())
-        else:
-            try:
-                handler = self._command_handlers[data]
-            except KeyError:
-                return
-            while len(received_data) < handler.bytes_needed:
-                received_data.append(ord(self.sp.read()))
-        # Handle the data
+        data = self.sp.read(self.bytes_available() or 1)
+        if data:
+            self._parse(data)
+        return len(data)
+
+    def _parse(self, data):
+        """
+        Runs ``data`` through the incoming message state machine, dispatching
+        every message that gets completed to its command handler.
+
+        The state is kept in ``_command`` (the pending command byte),
+        ``_stored_data`` (the data bytes collected for it so far) and
+        ``_parsing_sysex``, so a message can be split over any number of
+        reads. Handlers are looked up by command byte in
+        ``_command_handlers``, and complete two byte channel messages (the
+        bulk of the traffic) are handed to theirs without collecting them
+        first.
+        """
+        data = bytearray(data)
+        handlers = self._command_handlers
+        command = self._command
+        stored = self._stored_data
+        parsing_sysex = self._parsing_sysex
+        dropped = self._dropped_bytes
+        if command is not None:
+            handler, bytes_needed = handlers[command]
+        i, length = 0, len(data)
         try:
-            handler(*received_data)
-        except ValueError:
-            pass
+            while i < length:
+                if parsing_sysex:
+                    # Bulk copy everything up to END_SYSEX instead of going
+                    # byte by byte, sysex replies can be hundreds of bytes.
+                    end = data.find(END_SYSEX, i)
+                    if end == -1:
+                        stored.extend(data[i:])
+                        break
+                    stored.extend(data[i:end])
+                    i = end + 1
+                    parsing_sysex = False
+                    if stored and handlers[stored[0]]:
+                        try:
+                            handlers[stored[0]][0](*stored[1:])
+                        except ValueError:
+                            pass
+                    else:
+                        dropped += len(stored) + 2
+                    continue
+
+                byte = data[i]
+                i += 1
+                if byte < 0x80:
+                    # A data byte
+                    if command is None:
+                        # Not part of any message we know of, skip it
+                        dropped += 1
+                        continue
+                    stored.append(byte)
+                elif byte == START_SYSEX:
+                    if command is not None:
+                        # The channel of channel commands is in stored
+                        dropped += len(stored) + (command > START_SYSEX)
+                    command = None
+                    parsing_sysex = True
+                    stored = []
+                    continue
+                else:
+                    # A new command byte, which also aborts a pending message
+                    if command is not None:
+                        dropped += len(stored) + (command > START_SYSEX)
+                    entry = handlers[byte]
+                    if entry is None:
+                        dropped += 1
+                        command = None
+                        continue
+                    handler, bytes_needed = entry
+                    if byte < START_SYSEX:
+                        # These commands can have 'channel data' like a pin
+                        # number appended.
+                        if (bytes_needed == 3 and i + 1 < length and data[i] < 0x80
+                                and data[i + 1] < 0x80):
+                            i += 2
+                            command = None
+                            try:
+                                handler(byte & 0x0F, data[i - 2], data[i - 1])
+                            except ValueError:
+                                pass
+                            continue
+                        stored = [byte & 0x0F]
+                    else:
+                        stored = []
+                    command = byte
+
+                if len(stored) >= bytes_needed:
+                    command = None
+                    try:
+                        handler(*stored)
+                    except ValueError:
+                        pass
+        finally:
+            self._command = command
+            self._stored_data = stored
+            self._parsing_sysex = parsing_sysex
+            self._dropped_bytes = dropped
 
     def get_firmata_version(self):
         """
@@ -309,6 +711,152 @@ class Board(object):
         """
         return self.firmata_version
 
+    def set_sampling_interval(self, interval):
+        """
+        Sets the interval in milliseconds at which the firmware reports the
+        values of analog pins. StandardFirmata defaults to 19 ms and doesn't
+        go below 1 ms, and the protocol doesn't go above 0x3FFF ms. Use
+        :meth:`Pin.sample_rate` to check how many values per second actually
+        come in.
+        """
+        if not isinstance(interval, numbers.Integral):
+            raise ValueError("The sampling interval must be a whole number of ms, "
+                             "not {0!r}".format(interval))
+        if interval < 1:
+            raise ValueError("The sampling interval can't be less than 1 ms")
+        if interval > 0x3FFF:
+            raise ValueError("The sampling interval can't be more than 16383 ms")
+        self.send_sysex(SAMPLING_INTERVAL, to_two_bytes(interval))
+        self.sampling_interval = interval
+
+    def analog_sample_rates(self):
+        """
+        Returns a dict of :meth:`Pin.sample_rate` for each reporting analog
+        pin, by pin number.
+        """
+        return dict((pin.pin_number, pin.sample_rate()) for pin in self.analog if pin.reporting)
+
+    def snapshot(self):
+        """
+        Returns the values of all pins as an ``(analog, digital)`` pair of
+        arrays, indexed by pin number. Both are copied at once, so they always
+        belong together, even while an :class:`Iterator` is updating them.
+
+        The arrays are NumPy float arrays if NumPy is installed, and arrays of
+        doubles otherwise. Pins that have no value yet are NaN.
+        """
+        with self._values_lock:
+            values = self._values[:]
+        if numpy is not None:
+            values = numpy.frombuffer(values, dtype=numpy.float64)
+        return values[:len(self.analog)], values[len(self.analog):]
+
+    def enable_stats(self):
+        """
+        Starts counting the traffic with the board, see :meth:`stats`. If it
+        was counted already, counting starts over.
+
+        Until this is called counting takes no time at all: this is what puts
+        the counting versions of the parser, the writes and the command
+        handlers in place.
+        """
+        self.disable_stats()
+        self._stats = {
+            'since': time.monotonic(),
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'dropped_bytes': self._dropped_bytes,
+            'messages': defaultdict(int),
+            'handler_time': defaultdict(float),
+            'parse_calls': 0,
+            'parse_time': 0.0,
+            'max_parse_time': 0.0,
+        }
+        self._parse = self._counting_parse
+        self._write = self._counting_write
+        handlers = self._command_handlers
+        for cmd, entry in enumerate(handlers):
+            if entry is not None:
+                handlers[cmd] = (self._timed_handler(cmd, entry[0]), entry[1])
+
+    def disable_stats(self):
+        """Stops counting the traffic with the board."""
+        if self._stats is None:
+            return
+        self._stats = None
+        del self._parse, self._write
+        handlers = self._command_handlers
+        for cmd, entry in enumerate(handlers):
+            if entry is not None:
+                handlers[cmd] = (entry[0]._untimed, entry[1])
+
+    def stats(self):
+        """
+        Returns the traffic with the board since :meth:`enable_stats`, as a
+        dict of:
+
+        ``elapsed``
+            The number of seconds counted.
+        ``bytes_in``, ``bytes_out``
+            The number of bytes read from and written to the board.
+        ``dropped_bytes``
+            The number of bytes read that weren't part of a message with a
+            handler: unknown commands, messages cut off by the next one, and
+            bytes that didn't belong to any message.
+        ``messages``, ``handler_time``
+            The number of messages handled, and the seconds spent in their
+            handlers, by command (``ANALOG_MESSAGE``, ``DIGITAL_MESSAGE``, and
+            so on) or, for sysex messages, by sysex command.
+        ``parse_calls``, ``parse_time``, ``max_parse_time``
+            The number of times incoming data was handled (once per
+            :meth:`iterate`), and the total and longest time that took,
+            handlers included.
+        """
+        if self._stats is None:
+            raise IOError("Stats are not enabled for {0}".format(self))
+        stats = dict(self._stats)
+        stats['elapsed'] = time.monotonic() - stats.pop('since')
+        stats['dropped_bytes'] = self._dropped_bytes - stats['dropped_bytes']
+        stats['messages'] = dict(stats['messages'])
+        stats['handler_time'] = dict(stats['handler_time'])
+        return stats
+
+    def _counting_parse(self, data):
+        """:meth:`_parse`, while stats are enabled."""
+        stats = self._stats
+        start = time.perf_counter()
+        try:
+            type(self)._parse(self, data)
+        finally:
+            elapsed = time.perf_counter() - start
+            stats['bytes_in'] += len(data)
+            stats['parse_calls'] += 1
+            stats['parse_time'] += elapsed
+            if elapsed > stats['max_parse_time']:
+                stats['max_parse_time'] = elapsed
+
+    def _counting_write(self, msg):
+        """:meth:`_write`, while stats are enabled."""
+        self._stats['bytes_out'] += len(msg)
+        type(self)._write(self, msg)
+
+    def _timed_handler(self, cmd, handler):
+        """Returns ``handler``, counting and timing its calls."""
+        key = cmd & 0xF0 if 0x80 <= cmd < START_SYSEX else cmd
+        messages = self._stats['messages']
+        handler_time = self._stats['handler_time']
+        perf_counter = time.perf_counter
+
+        def timed(*args):
+            start = perf_counter()
+            try:
+                handler(*args)
+            finally:
+                handler_time[key] += perf_counter() - start
+                messages[key] += 1
+        timed._untimed = handler
+        return timed
+
     def servo_config(self, pin, min_pulse=544, max_pulse=2400, angle=0):
         """
         Configure a pin as servo with min_pulse, max_pulse and first angle.
@@ -321,12 +869,143 @@ class Board(object):
         data += to_two_bytes(min_pulse)
         data += to_two_bytes(max_pulse)
         self.send_sysex(SERVO_CONFIG, data)
+        # So the angle is written, see Pin._set_mode
+        self.digital[pin].value = None
 
         # set pin._mode to SERVO so that it sends analog messages
         # don't set pin.mode as that calls this method
         self.digital[pin]._mode = SERVO
+        if self.digital[pin].port:
+            self.digital[pin].port._reset_output(self.digital[pin])
         self.digital[pin].write(angle)
 
+    def i2c_config(self, delay=0):
+        """
+        Enables I2C on the board. Call this before any other ``i2c_`` method.
+
+        :arg delay: Microseconds the firmware waits between writing the
+            register and reading the data, for devices that need it.
+        """
+        self.send_sysex(I2C_CONFIG, to_two_bytes(delay))
+
+    def _i2c_request(self, address, mode, data=()):
+        if not 0 <= address <= 0x3FF:
+            raise ValueError("Invalid I2C address: {0}".format(address))
+        if address > 0x7F:
+            mode |= I2C_10BIT_ADDRESS | address >> 7
+        msg = bytearray([START_SYSEX, I2C_REQUEST, address & 0x7F, mode])
+        for byte in data:
+            msg += to_two_bytes(byte)
+        msg.append(END_SYSEX)
+        self._write(msg)
+
+    def i2c_write(self, address, data):
+        """
+        Writes the bytes in ``data`` to the I2C device at ``address``. To write
+        to a register, start with the register.
+        """
+        self._i2c_request(address, I2C_WRITE, data)
+
+    def i2c_read(self, address, register=None, count=1):
+        """
+        Reads ``count`` bytes from the I2C device at ``address``, starting at
+        ``register`` if one is given.
+
+        Returns a :class:`concurrent.futures.Future` that gets the bytes in a
+        ``bytearray`` when the reply is handled by :meth:`iterate`, fewer than
+        ``count`` if the device sent fewer. Reads of the same register get
+        their replies in the order they were made.
+        """
+        return self.i2c_read_many(address, [(register, count)], merge=False)[0]
+
+    def i2c_read_many(self, address, reads, merge=True):
+        """
+        Reads several registers of the I2C device at ``address`` and writes
+        the requests in one go.
+
+        :arg reads: ``(register, count)`` pairs.
+        :arg merge: Read the registers of reads that follow on from each
+            other in one request, which works with devices that move on to
+            the next register after every byte read, as most do.
+
+        Returns a :class:`concurrent.futures.Future` for every read, see
+        :meth:`i2c_read`.
+        """
+        futures = []
+        requests = []
+        for register, count in reads:
+            future = Future()
+            futures.append(future)
+            last = requests[-1] if requests else None
+            follows = last and last[0] is not None and last[0] + len(last[1]) == register
+            if merge and follows:
+                # (register, buffer, [(future, start, end)]), see _handle_i2c_reply
+                last[2].append((future, len(last[1]), len(last[1]) + count))
+                last[1].extend(bytearray(count))
+            else:
+                requests.append((register, bytearray(count), [(future, 0, count)]))
+        with self.batch():
+            for register, buffer, parts in requests:
+                # Queued before it's requested, the reply could come before
+                # this returns
+                self._i2c_reads.setdefault((address, register), deque()).append((buffer, parts))
+                data = [len(buffer)] if register is None else [register, len(buffer)]
+                self._i2c_request(address, I2C_READ, data)
+        return futures
+
+    def i2c_read_continuous(self, address, register, count, callback):
+        """
+        Makes the firmware read ``count`` bytes from the I2C device at
+        ``address``, starting at ``register``, every sampling interval (see
+        :meth:`set_sampling_interval`) until :meth:`i2c_stop_reading`.
+
+        ``callback(data)`` is called with every reply. ``data`` is a
+        ``bytearray`` that is reused for every reply: copy it to keep it. It
+        is a shorter copy if the device sent fewer than ``count`` bytes.
+        More callbacks can be added for the same register, with the same
+        ``count``.
+        """
+        key = (address, register)
+        stream = self._i2c_streams.get(key)
+        if stream is not None:
+            if len(stream[0]) != count:
+                raise ValueError("Register {0} of I2C device {1} is already read {2} bytes at "
+                                 "a time".format(register, address, len(stream[0])))
+            stream[1].append(callback)
+            return
+        self._i2c_streams[key] = (bytearray(count), [callback])
+        data = [count] if register is None else [register, count]
+        self._i2c_request(address, I2C_READ_CONTINUOUSLY, data)
+
+    def i2c_stop_reading(self, address):
+        """Stops all continuous reads from the I2C device at ``address``."""
+        self._i2c_request(address, I2C_STOP_READING)
+        for key in [key for key in self._i2c_streams if key[0] == address]:
+            del self._i2c_streams[key]
+
+    def _write_analog(self, pin_number, value):
+        """
+        Writes the raw ``value`` of a PWM or servo pin. An analog message only
+        has room for pins 0 to 15 and 14-bit values, anything else goes in an
+        EXTENDED_ANALOG message.
+        """
+        if pin_number < 16 and 0 <= value <= 0x3FFF:
+            self._write(bytearray([ANALOG_MESSAGE + pin_number, value % 128, value >> 7]))
+            return
+        if not 0 <= pin_number <= 0x7F:
+            raise IOError("Pin {0} can't be written to through Firmata".format(pin_number))
+        if value < 0:
+            raise ValueError("Can't write a negative value: {0}".format(value))
+        msg = bytearray([START_SYSEX, EXTENDED_ANALOG, pin_number])
+        # 7 bits at a time, at least 14
+        msg += to_two_bytes(value & 0x3FFF)
+        value >>= 14
+        while value:
+            msg.append(value & 0x7F)
+            value >>= 7
+        msg.append(END_SYSEX)
+        self._write(msg)
+
     def exit(self):
         """Call this to exit cleanly."""
         # First detach all servo's, otherwise it somehow doesn't want to close...
@@ -334,18 +1013,47 @@ class Board(object):
             for pin in self.digital:
                 if pin.mode == SERVO:
                     pin.mode = OUTPUT
+        self.stop_writer()
+        self.stop_recording()
+        for reads in getattr(self, '_i2c_reads', {}).values():
+            for buffer, parts in reads:
+                for future, start, end in parts:
+                    future.cancel()
         if hasattr(self, 'sp'):
             self.sp.close()
 
     # Command handlers
     def _handle_analog_message(self, pin_nr, lsb, msb):
-        value = round(float((msb << 7) + lsb) / 1023, 4)
-        # Only set the value if we are actually reporting
+        raw = (msb << 7) + lsb
         try:
-            if self.analog[pin_nr].reporting:
-                self.analog[pin_nr].value = value
+            pin = self._analog_by_channel[pin_nr]
         except IndexError:
             raise ValueError
+        if pin is None:
+            raise ValueError
+        # Only set the value if we are actually reporting
+        if not pin.reporting:
+            return
+        pin._sample_count += 1
+        old_raw, pin._raw_value = pin._raw_value, raw
+        timestamp = None
+        if pin._history is not None:
+            timestamp = time.monotonic()
+            pin._history.append(timestamp, raw)
+        if pin._raw:
+            pin._values[pin._index] = NAN
+            if pin._change_callbacks and raw != old_raw:
+                pin._notify_change(old_raw, raw, timestamp or time.monotonic())
+            return
+        scale = pin._scale
+        value = scale[raw] if raw < len(scale) else round(raw / pin._max_value, 4)
+        if pin._change_callbacks:
+            old_value = pin.value
+            pin.value = value
+            if value != old_value:
+                pin._notify_change(old_value, value, timestamp or time.monotonic())
+        else:
+            pin._values[pin._index] = value
 
     def _handle_digital_message(self, port_nr, lsb, msb):
         """
@@ -367,34 +1075,78 @@ class Board(object):
         self.firmware_version = (major, minor)
         self.firmware = two_byte_iter_to_str(data[2:])
 
-    def _handle_report_capability_response(self, *data):
-        charbuffer = []
-        pin_spec_list = []
-
-        for c in data:
-            if c == CAPABILITY_RESPONSE:
-                continue
+    def _handle_i2c_reply(self, *data):
+        address = data[0] | data[1] << 7
+        register = data[2] | data[3] << 7
+        key = (address, register)
+        if key not in self._i2c_streams and key not in self._i2c_reads:
+            if register != I2C_NO_REGISTER:
+                return
+            key = (address, None)
+        stream = self._i2c_streams.get(key)
+        if stream is not None:
+            buffer, callbacks = stream
+        else:
+            reads = self._i2c_reads.get(key)
+            if not reads:
+                return
+            buffer, parts = reads.popleft()
+            if not reads:
+                del self._i2c_reads[key]
+        # Decode the data into the buffer in place. The firmware replies with
+        # fewer bytes than asked for if the device sent fewer, only those are
+        # passed on.
+        received = min(len(buffer), (len(data) - 4) // 2)
+        for i in range(received):
+            buffer[i] = (data[4 + 2 * i] | data[5 + 2 * i] << 7) & 0xFF
+        if received < len(buffer):
+            buffer = buffer[:received]
+        if stream is not None:
+            for callback in callbacks:
+                callback(buffer)
+            return
+        for future, start, end in parts:
+            # Skip reads that have been cancelled
+            if future.set_running_or_notify_cancel():
+                future.set_result(buffer if len(parts) == 1 else buffer[start:end])
 
-            charbuffer.append(c)
-            if c == 0x7F:
-                # A copy of charbuffer
-                pin_spec_list.append(charbuffer[:])
-                charbuffer = []
+    def _handle_analog_mapping_response(self, *data):
+        self._analog_mapping = data
 
-        self._layout = pin_list_to_board_dict(pin_spec_list)
+    def _handle_report_capability_response(self, *data):
+        if data[:1] == (CAPABILITY_RESPONSE,):
+            data = data[1:]
+        layout = capabilities_to_board_dict(parse_capability_response(data), self._analog_mapping)
+        previous_layout, self._layout = self._layout, layout
+        # A layout from the cache being checked, a new one is cached by
+        # auto_setup
+        if self._cache_key and previous_layout and layout != previous_layout:
+            warnings.warn("The layout of {0} differs from the cached one, reconnect to use "
+                          "the new layout".format(self.name), RuntimeWarning)
+            self._layout_cache.store(self._cache_key, layout)
 
 
 class Port(object):
     """An 8-bit port on the board."""
+    __slots__ = ('board', 'port_number', 'reporting', 'pins', '_output_mask', '_sent_mask',
+                 '_reported_mask', '_change_callbacks')
+
     def __init__(self, board, port_number, num_pins=8):
         self.board = board
         self.port_number = port_number
         self.reporting = False
+        # Bitmask of the output pins that are high, kept up to date by the
+        # pins, and the last mask that was sent to the board
+        self._output_mask = 0
+        self._sent_mask = None
+        # The last mask that was reported by the board
+        self._reported_mask = None
+        self._change_callbacks = ()
 
         self.pins = []
         for i in range(num_pins):
             pin_nr = i + self.port_number * 8
-            self.pins.append(Pin(self.board, pin_nr, type=DIGITAL, port=self))
+            self.pins.append(self.board._pin_class(self.board, pin_nr, type=DIGITAL, port=self))
 
     def __str__(self):
         return "Digital Port {0.port_number} on {0.board}".format(self)
@@ -403,7 +1155,7 @@ class Port(object):
         """Enable reporting of values for the whole port."""
         self.reporting = True
         msg = bytearray([REPORT_DIGITAL + self.port_number, 1])
-        self.board.sp.write(msg)
+        self.board._write(msg)
 
         for pin in self.pins:
             if pin.mode == INPUT:
@@ -413,42 +1165,152 @@ class Port(object):
         """Disable the reporting of the port."""
         self.reporting = False
         msg = bytearray([REPORT_DIGITAL + self.port_number, 0])
-        self.board.sp.write(msg)
+        self.board._write(msg)
 
     def write(self):
         """Set the output pins of the port to the correct state."""
-        mask = 0
+        self._output_mask = 0
         for pin in self.pins:
-            if pin.mode == OUTPUT:
-                if pin.value == 1:
-                    pin_nr = pin.pin_number - self.port_number * 8
-                    mask |= 1 << int(pin_nr)
-#        print("type mask", type(mask))
-#        print("type self.portnumber", type(self.port_number))
-#        print("type pinnr", type(pin_nr))
+            self._update_output(pin)
+        self._send_output()
+
+    def _update_output(self, pin):
+        """
+        Brings the bit of ``pin`` in the output mask up to date, without
+        sending the mask to the board.
+        """
+        if pin._mode is OUTPUT and pin._values[pin._index] == 1:
+            self._output_mask |= pin._port_bit
+        else:
+            self._output_mask &= ~pin._port_bit
+
+    def _reset_output(self, pin):
+        """
+        Like :meth:`_update_output`, for when the mode of ``pin`` changed. The
+        firmware drives the pin low then, so its bit in the mask that was sent
+        last isn't on anymore either.
+        """
+        self._update_output(pin)
+        if self._sent_mask is not None:
+            self._sent_mask &= ~pin._port_bit
+
+    def _write_output(self, pin):
+        """
+        Updates the output mask for ``pin``, and sends it to the board if that
+        changed it.
+        """
+        self._update_output(pin)
+        if self._output_mask != self._sent_mask:
+            self._send_output()
+
+    def _send_output(self):
+        mask = self._sent_mask = self._output_mask
         msg = bytearray([DIGITAL_MESSAGE + self.port_number, mask % 128, mask >> 7])
-        self.board.sp.write(msg)
+        self.board._write(msg)
+
+    def on_change(self, callback):
+        """
+        Registers ``callback`` to be called as ``callback(port, old_mask,
+        new_mask, timestamp)`` whenever the board reports a different mask
+        for this port. ``timestamp`` is the :func:`time.monotonic` time the
+        report was handled at.
+
+        Callbacks are called from whatever calls :meth:`Board.iterate`, so
+        usually the :class:`Iterator` thread. Returns ``callback``, so this
+        can be used as a decorator.
+        """
+        self._change_callbacks += (callback,)
+        return callback
+
+    def remove_on_change(self, callback):
+        """Unregisters a callback registered with :meth:`on_change`."""
+        self._change_callbacks = tuple(c for c in self._change_callbacks if c != callback)
 
     def _update(self, mask):
         """Update the values for the pins marked as input with the mask."""
-        if self.reporting:
+        if not self.reporting:
+            return
+        # Update all pins at once as far as Board.snapshot is concerned
+        with self.board._values_lock:
+            timestamp = None
             for pin in self.pins:
                 if pin.mode is INPUT:
-                    pin_nr = pin.pin_number - self.port_number * 8
-                    pin.value = (mask & (1 << pin_nr)) > 0
+                    old_value = pin.value
+                    pin.value = value = (mask & pin._port_bit) > 0
+                    if pin._history is not None:
+                        timestamp = timestamp or time.monotonic()
+                        pin._history.append(timestamp, value)
+                    if pin._change_callbacks and value != old_value:
+                        timestamp = timestamp or time.monotonic()
+                        pin._notify_change(old_value, value, timestamp)
+            old_mask = self._reported_mask
+            self._reported_mask = mask
+            if self._change_callbacks and mask != old_mask:
+                timestamp = timestamp or time.monotonic()
+                for callback in self._change_callbacks:
+                    callback(self, old_mask, mask, timestamp)
 
 
 class Pin(object):
     """A Pin representation"""
+    __slots__ = ('board', 'pin_number', 'type', 'port', 'PWM_CAPABLE', 'reporting', '_mode',
+                 '_port_bit', '_values', '_index', '_change_callbacks', '_history',
+                 '_sample_count', '_rate_mark', '_max_value', '_scale', '_raw', '_raw_value')
+
     def __init__(self, board, pin_number, type=ANALOG, port=None):
         self.board = board
         self.pin_number = pin_number
         self.type = type
         self.port = port
+        # The bit of this pin in its port's mask
+        self._port_bit = 1 << (pin_number % 8)
         self.PWM_CAPABLE = False
         self._mode = (type == DIGITAL and OUTPUT or INPUT)
         self.reporting = False
-        self.value = None
+        # Where the value of this pin lives in the board's value table
+        self._values = board._values
+        self._index = len(self._values)
+        self._values.append(NAN)
+        self._change_callbacks = ()
+        self._history = None
+        # The number of values that came in, and the (time, count) that
+        # sample_rate measures from
+        self._sample_count = 0
+        self._rate_mark = None
+        # The last raw value reported, and whether only that is kept, see
+        # enable_raw
+        self._raw = False
+        self._raw_value = None
+        self._set_resolution(DEFAULT_PWM_RESOLUTION if type == DIGITAL
+                             else DEFAULT_ANALOG_RESOLUTION)
+
+    def _set_resolution(self, bits):
+        """
+        Sets the raw value of 1.0 for an analog input or PWM output with a
+        resolution of ``bits``, and the table to scale reported values with.
+        """
+        self._max_value = (1 << bits) - 1
+        # Analog messages carry 14 bits at most
+        self._scale = scale_table(min(self._max_value, 0x3FFF)) if self.type == ANALOG else None
+
+    def _get_value(self):
+        value = self._values[self._index]
+        if value != value:
+            # NaN, there is no value yet
+            return None
+        if self.type == DIGITAL and self._mode in (INPUT, OUTPUT):
+            return bool(value)
+        return value
+
+    def _set_value(self, value):
+        self._values[self._index] = NAN if value is None else value
+
+    value = property(_get_value, _set_value)
+    """
+    The last value read from or written to the pin, or None. Booleans for
+    digital pins in INPUT or OUTPUT mode, and floats otherwise. The values of
+    all pins of a board are stored together, see :meth:`Board.snapshot`.
+    """
 
     def __str__(self):
         type = {ANALOG: 'Analog', DIGITAL: 'Digital'}[self.type]
@@ -457,11 +1319,17 @@ class Pin(object):
     def _set_mode(self, mode):
         if mode is UNAVAILABLE:
             self._mode = UNAVAILABLE
+            if self.port:
+                self.port._update_output(self)
             return
         if self._mode is UNAVAILABLE:
             raise IOError("{0} can not be used through Firmata".format(self))
         if mode is PWM and not self.PWM_CAPABLE:
             raise IOError("{0} does not have PWM capabilities".format(self))
+        # The firmware resets the output when the mode is set, and a value
+        # from another mode (or read as an input) hasn't been written in this
+        # one, so the next write must be sent whatever it is
+        self.value = None
         if mode == SERVO:
             if self.type != DIGITAL:
                 raise IOError("Only digital pins can drive servos! {0} is not"
@@ -470,9 +1338,15 @@ class Pin(object):
             self.board.servo_config(self.pin_number)
             return
 
-        # Set mode with SET_PIN_MODE message
+        # Set mode with SET_PIN_MODE message, which goes by the pin number
+        # of the firmware, not the analog channel
         self._mode = mode
-        self.board.sp.write(bytearray([SET_PIN_MODE, self.pin_number, mode]))
+        if self.port:
+            self.port._reset_output(self)
+        pin_number = self.pin_number
+        if self.type == ANALOG:
+            pin_number = self.board.analog_pins[pin_number]
+        self.board._write(bytearray([SET_PIN_MODE, pin_number, mode]))
         if mode == INPUT:
             self.enable_reporting()
 
@@ -491,8 +1365,9 @@ class Pin(object):
             raise IOError("{0} is not an input and can therefore not report".format(self))
         if self.type == ANALOG:
             self.reporting = True
+            self._rate_mark = (time.monotonic(), self._sample_count)
             msg = bytearray([REPORT_ANALOG + self.pin_number, 1])
-            self.board.sp.write(msg)
+            self.board._write(msg)
         else:
             self.port.enable_reporting()
             # TODO This is not going to work for non-optimized boards like Mega
@@ -502,11 +1377,77 @@ class Pin(object):
         if self.type == ANALOG:
             self.reporting = False
             msg = bytearray([REPORT_ANALOG + self.pin_number, 0])
-            self.board.sp.write(msg)
+            self.board._write(msg)
         else:
             self.port.disable_reporting()
             # TODO This is not going to work for non-optimized boards like Mega
 
+    def sample_rate(self):
+        """
+        Returns the number of values per second that came in for this analog
+        pin since the previous call, or since reporting was enabled for the
+        first call. Returns None if there is nothing to measure from yet.
+        """
+        now = time.monotonic()
+        mark, self._rate_mark = self._rate_mark, (now, self._sample_count)
+        if mark is None or now <= mark[0]:
+            return None
+        return (self._sample_count - mark[1]) / (now - mark[0])
+
+    def on_change(self, callback):
+        """
+        Registers ``callback`` to be called as ``callback(pin, old_value,
+        new_value, timestamp)`` whenever a value reported by the board differs
+        from the previous one. ``timestamp`` is the :func:`time.monotonic`
+        time the report was handled at.
+
+        Callbacks are called from whatever calls :meth:`Board.iterate`, so
+        usually the :class:`Iterator` thread. Returns ``callback``, so this
+        can be used as a decorator.
+        """
+        self._change_callbacks += (callback,)
+        return callback
+
+    def remove_on_change(self, callback):
+        """Unregisters a callback registered with :meth:`on_change`."""
+        self._change_callbacks = tuple(c for c in self._change_callbacks if c != callback)
+
+    def enable_history(self, size):
+        """
+        Start keeping the last ``size`` values reported for this pin, see
+        :meth:`history`. Any history kept so far is thrown away.
+        """
+        self._history = SampleHistory(size)
+
+    def disable_history(self):
+        """Stop keeping the history of this pin."""
+        self._history = None
+
+    def history(self, n=None, since=None):
+        """
+        Returns the values reported for this pin as a ``(timestamps,
+        values)`` pair of arrays, oldest first. Values are the raw integers
+        the board sent: 0 to 1023 for analog pins, 0 or 1 for digital ones.
+        Timestamps are :func:`time.monotonic` times.
+
+        :arg n: Only return the last ``n`` samples.
+        :arg since: Only return samples from this timestamp on.
+
+        Call :meth:`enable_history` first.
+        """
+        if self._history is None:
+            raise IOError("History is not enabled for {0}".format(self))
+        if since is not None:
+            timestamps, values = self._history.since(since)
+            if n is not None and n < len(values):
+                timestamps, values = timestamps[-n:], values[-n:]
+            return timestamps, values
+        return self._history.last(n)
+
+    def _notify_change(self, old_value, new_value, timestamp):
+        for callback in self._change_callbacks:
+            callback(self, old_value, new_value, timestamp)
+
     def read(self):
         """
         Returns the output value of the pin. This value is updated by the
@@ -517,6 +1458,34 @@ class Pin(object):
             raise IOError("Cannot read pin {0}".format(self.__str__()))
         return self.value
 
+    def read_raw(self):
+        """
+        Returns the last value reported for this analog pin as the integer
+        the board sent, from 0 to 1023 for a 10-bit input, or None.
+        """
+        if self.type != ANALOG:
+            raise IOError("{0} is not an analog pin".format(self))
+        return self._raw_value
+
+    def enable_raw(self):
+        """
+        Keeps only the raw values of this analog pin, for :meth:`read_raw`.
+        Reported values are no longer scaled: :meth:`read` returns None,
+        :meth:`Board.snapshot` has NaN for the pin, and :meth:`on_change`
+        callbacks get the raw values.
+        """
+        if self.type != ANALOG:
+            raise IOError("{0} is not an analog pin".format(self))
+        self._raw = True
+        self.value = None
+
+    def disable_raw(self):
+        """
+        Scales the reported values of this analog pin again, starting with
+        the next one that comes in.
+        """
+        self._raw = False
+
     def write(self, value):
         """
         Output a voltage from the pin
@@ -531,19 +1500,20 @@ class Pin(object):
         if self.mode is INPUT:
             raise IOError("{0} is set up as an INPUT and can therefore not be written to"
                           .format(self))
-        if value is not self.value:
+        if value != self._values[self._index]:
             self.value = value
             if self.mode is OUTPUT:
                 if self.port:
-                    self.port.write()
+                    self.port._write_output(self)
                 else:
                     msg = bytearray([DIGITAL_MESSAGE, self.pin_number, value])
-                    self.board.sp.write(msg)
+                    self.board._write(msg)
             elif self.mode is PWM:
-                value = int(round(value * 255))
-                msg = bytearray([ANALOG_MESSAGE + self.pin_number, value % 128, value >> 7])
-                self.board.sp.write(msg)
+                self.board._write_analog(self.pin_number, int(round(value * self._max_value)))
             elif self.mode is SERVO:
-                value = int(value)
-                msg = bytearray([ANALOG_MESSAGE + self.pin_number, value % 128, value >> 7])
-                self.board.sp.write(msg)
+                self.board._write_analog(self.pin_number, int(value))
+
+
+# The classes a board builds its layout with, subclasses can override these
+Board._port_class = Port
+Board._pin_class = Pin
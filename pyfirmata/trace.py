@@ -0,0 +1,177 @@
+"""
+Recording and replaying the data a board sends.
+
+Record what comes in from a board into a trace file::
+
+    >>> board.start_recording('field.pftr')
+    >>> ...
+    >>> board.stop_recording()
+
+And replay it later, without the board, in real time, faster, or as fast as
+possible::
+
+    >>> board = Board(ReplaySerial('field.pftr', speed=10, paused=True), layout,
+    ...               setup_timeout=0)
+    >>> board.analog[0].enable_reporting()
+    >>> board.sp.play()
+    >>> while not board.sp.finished:
+    ...     board.iterate()
+
+A trace file starts with ``TRACE_MAGIC``, followed by a record for every read
+from the port: the time it was read in seconds since recording started and
+the number of bytes read (``TRACE_RECORD``, a little-endian double and
+unsigned int), followed by the bytes themselves.
+"""
+from __future__ import division, unicode_literals
+
+import struct
+import threading
+import time
+
+from .mockup import MockupSerial
+
+TRACE_MAGIC = b'PFTR\x01'
+TRACE_RECORD = struct.Struct('<dI')
+
+
+class TraceWriter(object):
+    """
+    Writes a trace to ``file``, a path or a binary file object. Files opened
+    by the writer are closed by :meth:`close`, others are only flushed.
+    """
+
+    def __init__(self, file):
+        self._owns_file = not hasattr(file, 'write')
+        self._file = open(file, 'wb') if self._owns_file else file
+        self._file.write(TRACE_MAGIC)
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def write(self, data, timestamp=None):
+        """
+        Adds ``data`` to the trace, as read at ``timestamp`` seconds since
+        the writer was created, or now.
+        """
+        if timestamp is None:
+            timestamp = time.monotonic() - self._start
+        with self._lock:
+            if self._file is not None:
+                self._file.write(TRACE_RECORD.pack(timestamp, len(data)) + bytes(data))
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            if self._owns_file:
+                self._file.close()
+            else:
+                self._file.flush()
+            self._file = None
+
+
+def read_trace(file):
+    """
+    Yields the ``(timestamp, data)`` records of the trace in ``file``, a path
+    or a binary file object.
+    """
+    if not hasattr(file, 'read'):
+        with open(file, 'rb') as f:
+            for record in read_trace(f):
+                yield record
+        return
+    if file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+        raise ValueError("Not a pyFirmata trace: {0!r}".format(file))
+    while True:
+        header = file.read(TRACE_RECORD.size)
+        if len(header) < TRACE_RECORD.size:
+            return
+        timestamp, length = TRACE_RECORD.unpack(header)
+        yield timestamp, bytearray(file.read(length))
+
+
+class RecordingSerial(object):
+    """
+    Wraps a serial port, and writes everything read from it to ``trace``, a
+    :class:`TraceWriter`. See :meth:`~pyfirmata.Board.start_recording`.
+    """
+
+    def __init__(self, sp, trace):
+        self.sp = sp
+        self.trace = trace
+
+    def read(self, size=1):
+        data = self.sp.read(size)
+        if data:
+            self.trace.write(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.sp, name)
+
+
+class ReplaySerial(MockupSerial):
+    """
+    A serial port that plays back a trace, see :func:`read_trace` for
+    ``trace``. Whatever is written to it is thrown away.
+
+    :arg speed: How fast to play back, 1 for real time, 10 for ten times as
+        fast. The clock starts at the first read. With None, every read gets
+        the next data right away.
+    :arg paused: Don't play anything back until :meth:`play` is called, so
+        the board can be set up first (the board reads what's there when it
+        is created).
+    """
+
+    def __init__(self, trace, speed=1, port=None, paused=False):
+        super(ReplaySerial, self).__init__(port or str(trace), 57600)
+        self.speed = speed
+        self.paused = paused
+        self._records = read_trace(trace)
+        self._next = next(self._records, None)
+        self._start = None
+        self._first_timestamp = self._next[0] if self._next else 0
+
+    def play(self):
+        """Starts playing back, the clock starts now."""
+        self.paused = False
+        self._start = time.monotonic()
+
+    @property
+    def finished(self):
+        """Whether everything in the trace has been read."""
+        return self._next is None and not self
+
+    def _release(self, wait=False):
+        """
+        Makes the data that is due available. With ``wait``, first waits
+        until there is some if there isn't any.
+        """
+        if self.paused:
+            return
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+        while self._next is not None:
+            if self.speed is None:
+                if self:
+                    return
+            else:
+                due = self._start + (self._next[0] - self._first_timestamp) / self.speed
+                if due > now:
+                    if self or not wait:
+                        return
+                    time.sleep(due - now)
+                    now = time.monotonic()
+            self.extend(self._next[1])
+            self._next = next(self._records, None)
+
+    def read(self, count=1):
+        self._release(wait=True)
+        return super(ReplaySerial, self).read(count)
+
+    def write(self, value):
+        pass
+
+    def inWaiting(self):
+        self._release()
+        return len(self)
@@ -1,15 +1,26 @@
 from __future__ import division, unicode_literals
 
+import json
 import os
+import re
+import selectors
 import sys
 import threading
-import time
+import warnings
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 
 import serial
 
 from .boards import BOARDS
 
 
+class WriteQueueFullError(IOError):
+    pass
+
+
 def get_the_board(
     layout=BOARDS["arduino"], base_dir="/dev/", identifier="tty.usbserial"
 ):
@@ -21,39 +32,170 @@ def get_the_board(
     IOError if it can't find a board, on a serial, or if it finds more than
     one.
     """
-    from .pyfirmata import Board  # prevent a circular import
-
-    boards = []
-    for device in os.listdir(base_dir):
-        if device.startswith(identifier):
-            try:
-                board = Board(os.path.join(base_dir, device), layout)
-            except serial.SerialException:
-                pass
-            else:
-                boards.append(board)
+    boards = discover_boards(layout, base_dir, identifier)
     if len(boards) == 0:
         raise IOError(
             "No boards found in {0} with identifier {1}".format(base_dir, identifier)
         )
     elif len(boards) > 1:
+        for board in boards:
+            board.exit()
         raise IOError("More than one board found!")
     return boards[0]
 
 
+def discover_boards(layout=None, base_dir="/dev/", identifier="tty.usbserial", ports=None,
+                    setup_timeout=None, **kwargs):
+    """
+    Returns a list of all boards that run Firmata, on the devices in
+    ``base_dir`` whose names start with ``identifier``, or on ``ports`` if
+    that's given. The ports are probed at the same time, so this takes about
+    as long as the slowest one, and at most ``setup_timeout`` seconds
+    (``BOARD_SETUP_WAIT_TIME`` by default) plus the time it takes to set up
+    the boards.
+
+    The boards are set up with ``layout``, or with the layout they report if
+    it's None, and have their firmware name and version in ``firmware`` and
+    ``firmware_version``. Other keyword arguments are passed on to
+    :class:`~pyfirmata.Board`.
+    """
+    from . import pyfirmata  # prevent a circular import
+
+    if ports is None:
+        ports = [os.path.join(base_dir, device) for device in sorted(os.listdir(base_dir))
+                 if device.startswith(identifier)]
+    if setup_timeout is None:
+        setup_timeout = pyfirmata.BOARD_SETUP_WAIT_TIME
+
+    def probe(port):
+        try:
+            board = pyfirmata.Board(port, layout, setup_timeout=setup_timeout, **kwargs)
+        except IOError:  # includes serial.SerialException
+            return None
+        if board.firmware is None:
+            # The firmware name comes in after the version
+            board._wait_for(lambda: board.firmware is not None,
+                            pyfirmata.BOARD_SETUP_QUERY_INTERVAL)
+        return board
+
+    if not ports:
+        return []
+    with ThreadPoolExecutor(len(ports)) as executor:
+        boards = executor.map(probe, ports)
+    return [board for board in boards if board is not None]
+
+
+def usb_serial_number(port):
+    """
+    Returns the serial number of the USB device behind ``port``, or None if
+    it isn't known.
+    """
+    try:
+        from serial.tools import list_ports
+    except ImportError:
+        return None
+    device = os.path.realpath(port)
+    for info in list_ports.comports():
+        if info.device in (port, device):
+            return info.serial_number
+    return None
+
+
+class LayoutCache(object):
+    """
+    Keeps the layouts found with Firmata's capability query on disk, so a
+    board doesn't have to be queried again on the next connect. Pass one as
+    the ``layout_cache`` argument of :class:`Board`.
+
+    Layouts are kept by firmware name and version, and the USB serial number
+    of the board (or the port name if there is none). They are stored as JSON
+    files in ``directory``, which defaults to ``pyfirmata`` in the user's
+    cache directory.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+            directory = os.path.join(cache_home, 'pyfirmata')
+        self.directory = directory
+
+    def key(self, port, firmware, firmware_version):
+        """Returns the key the layout of the given board is kept under."""
+        device = usb_serial_number(port) or port
+        key = '{0}-{1}.{2}-{3}'.format(firmware, firmware_version[0], firmware_version[1], device)
+        return re.sub(r'[^\w.-]', '_', key)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """Returns the layout kept under ``key``, or None."""
+        try:
+            with open(self._path(key)) as f:
+                layout = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        return dict((name, _tuples(value)) for name, value in layout.items())
+
+    def store(self, key, layout):
+        """Keeps ``layout`` under ``key``."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Write to a temporary file first, so other processes never read half
+        # a layout
+        path = self._path(key)
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(layout, f)
+        os.replace(tmp_path, path)
+
+    def invalidate(self, key=None):
+        """Forgets the layout kept under ``key``, or all layouts if it's None."""
+        if key is None:
+            keys = [name[:-len('.json')] for name in os.listdir(self.directory)
+                    if name.endswith('.json')] if os.path.isdir(self.directory) else []
+        else:
+            keys = [key]
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+def _tuples(value):
+    """Turns the lists in ``value``, which came from JSON, back into tuples."""
+    if isinstance(value, list):
+        return tuple(_tuples(item) for item in value)
+    return value
+
+
 class Iterator(threading.Thread):
+    """
+    A thread that keeps the values of ``board`` up to date.
+
+    It blocks in the serial read until data comes in, so it handles messages
+    as soon as they arrive and doesn't use any CPU while the board is quiet.
+    Open the board without a serial ``timeout`` (the default) for this to work
+    best: with a timeout, the thread wakes up once per timeout, and on a
+    non-blocking port it falls back to polling every ``poll_interval``
+    seconds.
+    """
+
+    poll_interval = 0.001
 
     def __init__(self, board):
         super(Iterator, self).__init__()
         self.board = board
         self.daemon = True
+        self._stopping = threading.Event()
 
     def run(self):
-        while 1:
+        while not self._stopping.is_set():
             try:
-                while self.board.bytes_available():
-                    self.board.iterate()
-                time.sleep(0.001)
+                if not self.board.iterate():
+                    # The read timed out, or the port doesn't block at all
+                    self._stopping.wait(self.poll_interval)
             except (AttributeError, serial.SerialException, OSError):
                 # this way we can kill the thread by setting the board object
                 # to None, or when the serial port is closed by board.exit()
@@ -73,6 +215,284 @@ class Iterator(threading.Thread):
             except (KeyboardInterrupt):
                 sys.exit()
 
+    def stop(self):
+        """
+        Stops the thread. It is woken up if it is waiting for data, so a
+        ``join()`` after this returns promptly.
+        """
+        self._stopping.set()
+        cancel_read = getattr(getattr(self.board, 'sp', None), 'cancel_read', None)
+        if cancel_read is not None:
+            cancel_read()
+
+
+class BoardGroup(threading.Thread):
+    """
+    A thread that keeps the values of any number of boards up to date, like
+    an :class:`Iterator` for each of them, but without a thread per board.
+
+    It waits for data on all serial ports at once, and only hands a board its
+    data when its port is readable, so it uses no CPU while the boards are
+    quiet. Boards can be added and removed while it runs. Remove a board
+    before closing its port. A board whose port fails, or that raises any
+    other error while handling its data (in an ``on_change`` callback, say),
+    is removed with a warning, and the other boards carry on.
+    """
+
+    def __init__(self, boards=()):
+        super(BoardGroup, self).__init__()
+        self.daemon = True
+        self._selector = selectors.DefaultSelector()
+        self._boards = set()
+        # Changes are made by the thread itself, it's woken up for them
+        # through the wakeup pipe
+        self._changes = []
+        self._changes_lock = threading.Lock()
+        self._stopping = False
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_write, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+        for board in boards:
+            self.add(board)
+
+    @property
+    def boards(self):
+        """The boards in the group."""
+        with self._changes_lock:
+            boards = set(self._boards)
+            for add, board, fileno in self._changes:
+                (boards.add if add else boards.discard)(board)
+        return boards
+
+    def add(self, board):
+        """
+        Adds ``board`` to the group. Its port needs a ``fileno()``, errors
+        getting it (like a closed port) are raised here.
+        """
+        self._change(True, board, board.sp.fileno())
+
+    def remove(self, board):
+        """Removes ``board`` from the group."""
+        self._change(False, board)
+
+    def stop(self):
+        """Stops the thread."""
+        self._stopping = True
+        self._wakeup()
+
+    def _change(self, add, board, fileno=None):
+        with self._changes_lock:
+            self._changes.append((add, board, fileno))
+        self._wakeup()
+
+    def _wakeup(self):
+        with self._changes_lock:
+            if self._wakeup_write is None:
+                return  # the thread has stopped already
+            try:
+                os.write(self._wakeup_write, b'\0')
+            except BlockingIOError:
+                pass  # plenty of wakeups pending
+
+    def _apply_changes(self):
+        os.read(self._wakeup_read, 4096)
+        with self._changes_lock:
+            changes, self._changes = self._changes, []
+        for add, board, fileno in changes:
+            if add and board not in self._boards:
+                try:
+                    self._selector.register(fileno, selectors.EVENT_READ, board)
+                except (KeyError, ValueError, OSError) as e:
+                    # Closed in the meantime, or a port that's in already
+                    self._fail(board, e)
+                    continue
+                self._boards.add(board)
+            elif not add and board in self._boards:
+                self._discard(board)
+
+    def _fail(self, board, error):
+        """Removes ``board`` after ``error``, which is reported as a warning."""
+        warnings.warn("{0} was removed from the board group: {1!r}".format(board, error),
+                      RuntimeWarning)
+        self._discard(board)
+
+    def _discard(self, board):
+        for key in list(self._selector.get_map().values()):
+            if key.data is board:
+                self._selector.unregister(key.fileobj)
+        self._boards.discard(board)
+
+    def run(self):
+        try:
+            while not self._stopping:
+                for key, events in self._selector.select():
+                    board = key.data
+                    if board is None:
+                        self._apply_changes()
+                    elif board in self._boards:
+                        try:
+                            board.iterate()
+                        except Exception as e:
+                            self._fail(board, e)
+        finally:
+            self._selector.close()
+            with self._changes_lock:
+                os.close(self._wakeup_read)
+                os.close(self._wakeup_write)
+                self._wakeup_write = None
+
+
+class Writer(threading.Thread):
+    """
+    A thread that writes messages to a serial port, so whoever writes them
+    doesn't have to wait for the port. Start one for a board with
+    :meth:`~pyfirmata.Board.start_writer`.
+
+    Messages are queued whole and written whole, so messages written from
+    different threads never get mixed up. Whatever is queued by the time the
+    port is ready again goes out in one write.
+
+    :arg size: The maximum number of messages in the queue.
+    :arg overflow: What :meth:`write` does when the queue is full: ``'block'``
+        until there is room, ``'drop-oldest'`` to make room by throwing away
+        the oldest message (counted in ``dropped``), or ``'raise'`` a
+        :class:`WriteQueueFullError`.
+    """
+
+    def __init__(self, sp, size=1024, overflow='block'):
+        if overflow not in ('block', 'drop-oldest', 'raise'):
+            raise ValueError("Unknown overflow policy {0!r}".format(overflow))
+        super(Writer, self).__init__()
+        self.daemon = True
+        self.sp = sp
+        self.size = size
+        self.overflow = overflow
+        self.dropped = 0
+        # The exception that stopped the thread, if any
+        self.error = None
+        self._queue = deque()
+        self._writing = False
+        self._stopping = False
+        self._condition = threading.Condition()
+
+    def write(self, msg):
+        """Queues ``msg`` to be written."""
+        with self._condition:
+            if self._stopping:
+                raise IOError("The writer for {0} has stopped".format(self.sp.port))
+            if len(self._queue) >= self.size:
+                if self.overflow == 'raise':
+                    raise WriteQueueFullError("The write queue for {0} is full"
+                                              .format(self.sp.port))
+                elif self.overflow == 'drop-oldest':
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._queue) >= self.size and not self._stopping:
+                        self._condition.wait()
+            self._queue.append(bytes(msg))
+            self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits until everything queued has been written, or ``timeout``
+        seconds have passed. Returns whether the queue was emptied.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not (self._queue or self._writing), timeout)
+
+    def stop(self):
+        """
+        Stops the thread once everything queued has been written. Later
+        writes raise an ``IOError``.
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopping:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                data = b''.join(self._queue)
+                self._queue.clear()
+                self._writing = True
+                # Make room for blocked writers
+                self._condition.notify_all()
+            try:
+                self.sp.write(data)
+            except (serial.SerialException, OSError) as e:
+                self.error = e
+            finally:
+                with self._condition:
+                    self._writing = False
+                    if self.error is not None:
+                        self._stopping = True
+                        self._queue.clear()
+                    self._condition.notify_all()
+
+
+class SampleHistory(object):
+    """
+    A ring buffer of the last ``size`` samples, each an integer value with a
+    timestamp. All storage is allocated up front, adding a sample just
+    overwrites the oldest one.
+
+    Samples are returned as a ``(timestamps, values)`` pair of arrays, oldest
+    first. Timestamps are expected to never go down.
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("A history needs room for at least one sample")
+        self.size = size
+        self._timestamps = array('d', [0.0]) * size
+        self._values = array('l', [0]) * size
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, value):
+        i = self._next
+        self._timestamps[i] = timestamp
+        self._values[i] = value
+        self._next = i + 1 if i + 1 < self.size else 0
+        if self._count < self.size:
+            self._count += 1
+
+    def clear(self):
+        self._next = self._count = 0
+
+    def last(self, n=None):
+        """Returns the last ``n`` samples, or all of them if ``n`` is None."""
+        if n is None or n > self._count:
+            n = self._count
+        start = self._next - n
+        if start >= 0:
+            return self._timestamps[start:self._next], self._values[start:self._next]
+        # The samples wrap around the end of the buffer
+        return (self._timestamps[start:] + self._timestamps[:self._next],
+                self._values[start:] + self._values[:self._next])
+
+    def since(self, timestamp):
+        """Returns the samples taken at or after ``timestamp``."""
+        # Binary search for the number of samples before timestamp, counting
+        # from the oldest one
+        first = self._next - self._count
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamps[(first + mid) % self.size] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.last(self._count - lo)
+
 
 def to_two_bytes(integer):
     """
@@ -158,7 +578,26 @@ def break_to_bytes(value):
     return (c, int(value / c))
 
 
-def pin_list_to_board_dict(pinlist):
+def parse_capability_response(data):
+    """
+    Returns the capabilities of every pin in the data of a capability
+    response, as a ``{mode: resolution}`` dict per pin. Pins that can't be
+    used through Firmata have an empty dict.
+    """
+    capabilities = []
+    modes = {}
+    data = iter(data)
+    for byte in data:
+        if byte == 0x7F:
+            # End of a pin
+            capabilities.append(modes)
+            modes = {}
+        else:
+            modes[byte] = next(data, 0)
+    return capabilities
+
+
+def pin_list_to_board_dict(pinlist, analog_mapping=None):
     """
     Capability Response codes:
         INPUT:  0, 1
@@ -167,59 +606,58 @@ def pin_list_to_board_dict(pinlist):
         PWM:    3, 8
         SERV0:  4, 14
         I2C:    6, 1
+
+    :arg pinlist: The data of the capability response by pin, each ending
+        with 0x7F.
+    :arg analog_mapping: See :func:`capabilities_to_board_dict`.
     """
+    return capabilities_to_board_dict(parse_capability_response(chain.from_iterable(pinlist)),
+                                      analog_mapping)
 
+
+def capabilities_to_board_dict(capabilities, analog_mapping=None):
+    """
+    Returns the layout of a board with the ``capabilities`` of
+    :func:`parse_capability_response`. The layout has a ``capabilities``
+    entry with the modes and resolutions of every pin, as ``mode, resolution,
+    mode, resolution...`` tuples.
+
+    :arg analog_mapping: The data of the analog mapping response: the analog
+        channel of every pin, or 127 if it has none. Without it, the analog
+        pins are assumed to come last and in channel order. With it, analog
+        pins in between digital ones are digital pins too, and the layout
+        gets an ``analog_pins`` entry with the pin of every channel.
+    """
+    digital = analog = 0
+    pwm = []
+    disabled = []
+    for pin, modes in enumerate(capabilities):
+        if not modes:
+            disabled.append(pin)
+            digital += 1
+        elif 2 in modes:  # ANALOG
+            analog += 1
+        elif 0 in modes and 1 in modes:  # INPUT and OUTPUT
+            digital += 1
+        if 3 in modes:  # PWM
+            pwm.append(pin)
     board_dict = {
-        "digital": [],
-        "analog": [],
-        "pwm": [],
-        "servo": [],  # 2.2 specs
-        # 'i2c': [],  # 2.3 specs
-        "disabled": [],
+        "analog": tuple(range(analog)),
+        "disabled": tuple(disabled),
+        "capabilities": tuple(tuple(chain.from_iterable(modes.items()))
+                              for modes in capabilities),
     }
-    for i, pin in enumerate(pinlist):
-        pin.pop()  # removes the 0x79 on end
-        if not pin:
-            board_dict["disabled"] += [i]
-            board_dict["digital"] += [i]
-            continue
-
-        for j, _ in enumerate(pin):
-            # Iterate over evens
-            if j % 2 == 0:
-                # This is safe. try: range(10)[5:50]
-                if pin[j:j + 4] == [0, 1, 1, 1]:
-                    board_dict["digital"] += [i]
-
-                if pin[j:j + 2] == [2, 10]:
-                    board_dict["analog"] += [i]
-
-                if pin[j:j + 2] == [3, 8]:
-                    board_dict["pwm"] += [i]
-
-                if pin[j:j + 2] == [4, 14]:
-                    board_dict["servo"] += [i]
-
-                # Desable I2C
-                if pin[j:j + 2] == [6, 1]:
-                    pass
-
-    # We have to deal with analog pins:
-    # - (14, 15, 16, 17, 18, 19)
-    # + (0, 1, 2, 3, 4, 5)
-    diff = set(board_dict["digital"]) - set(board_dict["analog"])
-    board_dict["analog"] = [n for n, _ in enumerate(board_dict["analog"])]
-
-    # Digital pin problems:
-    # - (2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15)
-    # + (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13)
-
-    board_dict["digital"] = [n for n, _ in enumerate(diff)]
-    # Based on lib Arduino 0017
-    board_dict["servo"] = board_dict["digital"]
-
-    # Turn lists into tuples
-    # Using dict for Python 2.6 compatibility
-    board_dict = dict([(key, tuple(value)) for key, value in board_dict.items()])
-
+    if analog_mapping is not None:
+        channels = sorted((channel, pin) for pin, channel in enumerate(analog_mapping)
+                          if channel != 127)
+        board_dict["analog"] = tuple(channel for channel, pin in channels)
+        board_dict["analog_pins"] = tuple(pin for channel, pin in channels)
+        # The digital pins are the ones before the analog pins at the end
+        digital = len(capabilities)
+        while digital and digital <= len(analog_mapping) and analog_mapping[digital - 1] != 127:
+            digital -= 1
+    # Based on lib Arduino 0017, all digital pins can drive servos
+    board_dict["digital"] = board_dict["servo"] = tuple(range(digital))
+    # Analog pins can have PWM too, but there are no digital pins to use it on
+    board_dict["pwm"] = tuple(pin for pin in pwm if pin < digital)
     return board_dict
@@ -14,7 +14,9 @@ setup(
     author_email='tinodb@gmail.com',
     packages=['pyfirmata'],
     include_package_data=True,
+    python_requires='>=3.6',
     install_requires=['pyserial'],
+    extras_require={'numpy': ['numpy']},
     zip_safe=False,
     url='https://github.com/tino/pyFirmata',
     classifiers=[
@@ -24,11 +26,9 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
         'Topic :: Utilities',
         'Topic :: Home Automation',
     ],
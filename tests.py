@@ -1,17 +1,30 @@
 from __future__ import division, unicode_literals
 
+import asyncio
+import io
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import warnings
 from itertools import chain
 
 import serial
 
 import pyfirmata
-from pyfirmata import mockup
+from pyfirmata import aio, mockup, trace, util
 from pyfirmata.boards import BOARDS
 from pyfirmata.util import (
-    break_to_bytes, from_two_bytes, str_to_two_byte_iter, to_two_bytes, two_byte_iter_to_str
+    SampleHistory, break_to_bytes, from_two_bytes, str_to_two_byte_iter, to_two_bytes,
+    two_byte_iter_to_str
 )
 
+# The tests patch serial.Serial with the mockup, keep the real one around
+REAL_SERIAL = serial.Serial
+
 
 # Messages todo left:
 
@@ -26,12 +39,10 @@ class BoardBaseTest(unittest.TestCase):
     def setUp(self):
         # Test with the MockupSerial so no real connection is needed
         pyfirmata.pyfirmata.serial.Serial = mockup.MockupSerial
-        # Set the wait time to a zero so we won't have to wait a couple of secs
-        # each test
+        # Set the wait time to zero to skip waiting for the firmware to answer,
+        # the mockup never does
         pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0
         self.board = pyfirmata.Board('', BOARDS['arduino'])
-        self.board._stored_data = []
-        # FIXME How can it be that a fresh instance sometimes still contains data?
 
 
 class TestBoardMessages(BoardBaseTest):
@@ -65,6 +76,123 @@ class TestBoardMessages(BoardBaseTest):
         self.board._handle_digital_message(0, mask % 128, mask >> 7)
         self.assertEqual(self.board.digital[5].read(), True)
 
+    def test_analog_on_change(self):
+        changes = []
+        pin = self.board.analog[3]
+        pin.reporting = True
+        pin.on_change(lambda *args: changes.append(args))
+        self.board._handle_analog_message(3, 127, 7)
+        self.board._handle_analog_message(3, 127, 7)
+        self.board._handle_analog_message(3, 0, 0)
+        self.assertEqual([c[:3] for c in changes], [(pin, None, 1.0), (pin, 1.0, 0.0)])
+        self.assertTrue(changes[0][3] <= changes[1][3])
+
+    def test_digital_on_change(self):
+        pin_changes, port_changes = [], []
+        port = self.board.digital_ports[0]
+        port.reporting = True
+        self.board.digital[5]._mode = pyfirmata.INPUT
+        self.board.digital[6]._mode = pyfirmata.INPUT
+        callback = self.board.digital[5].on_change(lambda *args: pin_changes.append(args[:3]))
+        port.on_change(lambda *args: port_changes.append(args[:3]))
+        self.board._handle_digital_message(0, 1 << 5, 0)
+        self.board._handle_digital_message(0, 1 << 5 | 1 << 6, 0)
+        self.board.digital[5].remove_on_change(callback)
+        self.board._handle_digital_message(0, 0, 0)
+        self.assertEqual(pin_changes, [(self.board.digital[5], None, True)])
+        self.assertEqual(port_changes, [
+            (port, None, 1 << 5), (port, 1 << 5, 1 << 5 | 1 << 6), (port, 1 << 5 | 1 << 6, 0)
+        ])
+
+    def test_history(self):
+        analog, digital = self.board.analog[3], self.board.digital[5]
+        analog.reporting = True
+        self.board.digital_ports[0].reporting = True
+        digital._mode = pyfirmata.INPUT
+        self.assertRaises(IOError, analog.history)
+        analog.enable_history(3)
+        digital.enable_history(3)
+        for raw in (10, 20, 30, 40):
+            self.board._handle_analog_message(3, raw, 0)
+        self.board._handle_digital_message(0, 1 << 5, 0)
+        timestamps, values = analog.history()
+        self.assertEqual(list(values), [20, 30, 40])
+        self.assertEqual(list(timestamps), sorted(timestamps))
+        self.assertEqual(list(analog.history(n=1)[1]), [40])
+        self.assertEqual(list(analog.history(since=timestamps[1])[1]), [30, 40])
+        self.assertEqual(list(digital.history()[1]), [1])
+
+    def test_snapshot(self):
+        self.board.analog[1].reporting = True
+        self.board.digital_ports[1].reporting = True
+        self.board.digital[9]._mode = pyfirmata.INPUT
+        self.board.digital[13].mode = pyfirmata.OUTPUT
+        self.board._handle_analog_message(1, 127, 7)
+        self.board._handle_digital_message(1, 1 << 1, 0)
+        self.board.digital[13].write(1)
+        analog, digital = self.board.snapshot()
+        self.assertEqual(len(analog), len(self.board.analog))
+        self.assertEqual(len(digital), len(self.board.digital))
+        self.assertEqual(analog[1], 1.0)
+        self.assertEqual(digital[9], 1.0)
+        self.assertEqual(digital[13], 1.0)
+        self.assertNotEqual(analog[0], analog[0])  # NaN, no value
+        # It's a copy
+        self.board._handle_analog_message(1, 0, 0)
+        self.assertEqual(analog[1], 1.0)
+        if pyfirmata.pyfirmata.numpy is not None:
+            self.assertEqual(analog.dtype, pyfirmata.pyfirmata.numpy.float64)
+
+    def test_snapshot_without_numpy(self):
+        numpy, pyfirmata.pyfirmata.numpy = pyfirmata.pyfirmata.numpy, None
+        try:
+            self.board.analog[1].value = 0.5
+            analog, digital = self.board.snapshot()
+        finally:
+            pyfirmata.pyfirmata.numpy = numpy
+        self.assertEqual(analog.typecode, 'd')
+        self.assertEqual(analog[1], 0.5)
+
+    def test_value_types(self):
+        self.board.digital[13].mode = pyfirmata.OUTPUT
+        self.board.digital[13].write(1)
+        self.assertIs(self.board.digital[13].value, True)
+        self.board.digital[3].mode = pyfirmata.PWM
+        self.board.digital[3].write(0.5)
+        self.assertEqual(self.board.digital[3].value, 0.5)
+        self.board.digital[3].value = None
+        self.assertEqual(self.board.digital[3].value, None)
+
+    def test_sample_rate(self):
+        pin = self.board.analog[2]
+        self.assertEqual(pin.sample_rate(), None)
+        pin.enable_reporting()
+        start = time.monotonic()
+        for i in range(10):
+            self.board._handle_analog_message(2, i, 0)
+        time.sleep(0.01)
+        rate = pin.sample_rate()
+        self.assertTrue(0 < rate <= 10 / (time.monotonic() - start) * 1.5)
+        time.sleep(0.01)
+        self.assertEqual(pin.sample_rate(), 0)
+        self.assertEqual(list(self.board.analog_sample_rates()), [2])
+
+    # Sampling interval
+    # 0  START_SYSEX (0xF0)
+    # 1  SAMPLING_INTERVAL (0x7A)
+    # 2  sampling interval on the millisecond time scale (LSB)
+    # 3  sampling interval on the millisecond time scale (MSB)
+    # 4  END_SYSEX (0xF7)
+    def test_set_sampling_interval(self):
+        self.board.set_sampling_interval(200)
+        self.assert_serial(0xF0, 0x7A, 200 % 128, 200 >> 7, 0xF7)
+        self.assertEqual(self.board.sampling_interval, 200)
+        self.assertRaises(ValueError, self.board.set_sampling_interval, 0)
+        self.assertRaises(ValueError, self.board.set_sampling_interval, 0x4000)
+        self.assertRaises(ValueError, self.board.set_sampling_interval, 2.5)
+        self.board.set_sampling_interval(0x3FFF)
+        self.assert_serial(0xF0, 0x7A, 0x7F, 0x7F, 0xF7)
+
     def test_handle_report_version(self):
         self.assertEqual(self.board.firmata_version, None)
         self.board._handle_report_version(2, 1)
@@ -96,6 +224,31 @@ class TestBoardMessages(BoardBaseTest):
         self.assertEqual(self.board.analog[4].read(), 1.0)
         self.board._stored_data = []
 
+    def test_read_raw(self):
+        pin = self.board.analog[4]
+        pin.enable_reporting()
+        self.board.sp.clear()
+        self.assertEqual(pin.read_raw(), None)
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 4, 0x7F, 3])
+        self.board.iterate()
+        self.assertEqual(pin.read_raw(), 511)
+        self.assertEqual(pin.read(), 0.4995)
+        changes = []
+        pin.on_change(lambda pin, old, new, timestamp: changes.append((old, new)))
+        pin.enable_raw()
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 4, 0x7F, 7])
+        self.board.iterate()
+        self.assertEqual(pin.read_raw(), 1023)
+        self.assertEqual(pin.read(), None)
+        self.assertTrue(math.isnan(self.board.snapshot()[0][4]))
+        self.assertEqual(changes, [(511, 1023)])
+        pin.disable_raw()
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 4, 0, 0])
+        self.board.iterate()
+        self.assertEqual(pin.read(), 0.0)
+        self.assertEqual(changes[-1], (None, 0.0))
+        self.assertRaises(IOError, self.board.digital[2].read_raw)
+
     def test_handle_capability_response(self):
         """
         Capability Response codes:
@@ -298,6 +451,222 @@ class TestBoardMessages(BoardBaseTest):
             self.board.iterate()
         self.assertEqual(self.board.analog[4].read(), 1.0)
 
+    def test_iterate_reads_all_waiting_messages(self):
+        self.board.analog[2].enable_reporting()
+        self.board.analog[3].enable_reporting()
+        self.board.sp.clear()
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 2, 127, 7])
+        self.board.sp.write([pyfirmata.REPORT_VERSION, 2, 5])
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 3, 0, 0])
+        self.board.iterate()
+        self.assertEqual(len(self.board.sp), 0)
+        self.assertEqual(self.board.analog[2].read(), 1.0)
+        self.assertEqual(self.board.analog[3].read(), 0.0)
+        self.assertEqual(self.board.firmata_version, (2, 5))
+
+    def test_message_split_over_reads(self):
+        """
+        A message that is only partially received should be completed on the
+        next call to iterate.
+        """
+        self.board.analog[4].enable_reporting()
+        self.board.sp.clear()
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 4, 127])
+        self.board.iterate()
+        self.assertEqual(self.board.analog[4].read(), None)
+        self.board.sp.write([7])
+        self.board.iterate()
+        self.assertEqual(self.board.analog[4].read(), 1.0)
+
+        msg = [pyfirmata.START_SYSEX, pyfirmata.REPORT_FIRMWARE, 2, 1]
+        msg += list(str_to_two_byte_iter('Firmware_name')) + [pyfirmata.END_SYSEX]
+        for byte in msg:
+            self.board.sp.write(byte)
+            self.board.iterate()
+        self.assertEqual(self.board.firmware, 'Firmware_name')
+
+    def test_interrupted_message_is_dropped(self):
+        """
+        A command byte in the middle of a message starts a new message, the
+        incomplete one is thrown away.
+        """
+        self.board.analog[4].enable_reporting()
+        self.board.sp.clear()
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 4, 127])
+        self.board.sp.write([pyfirmata.REPORT_VERSION, 2, 1])
+        self.board.iterate()
+        self.assertEqual(self.board.analog[4].read(), None)
+        self.assertEqual(self.board.firmata_version, (2, 1))
+
+    def test_add_cmd_handler(self):
+        received = []
+        self.board.add_cmd_handler(0xA0, lambda channel, lsb, msb: received.append(
+            (channel, lsb, msb)))
+        self.board.add_cmd_handler(0x10, lambda *data: received.append(data))
+        self.board.sp.write([0xA0, 1, 2, 0xA5, 3])
+        self.board.iterate()
+        self.board.sp.write([4, pyfirmata.START_SYSEX, 0x10, 5, 6, pyfirmata.END_SYSEX])
+        self.board.iterate()
+        self.assertEqual(received, [(0, 1, 2), (5, 3, 4), (5, 6)])
+
+    def test_boards_have_their_own_parser(self):
+        other = mockup.MockupBoard('other', BOARDS['arduino'])
+        self.board.analog[0].reporting = True
+        other.analog[0].reporting = True
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE, 127, 7])
+        self.board.iterate()
+        self.assertEqual(self.board.analog[0].read(), 1.0)
+        self.assertEqual(other.analog[0].read(), None)
+
+        # A message split over reads on one board doesn't get mixed up with
+        # the other's
+        other.sp.write([pyfirmata.ANALOG_MESSAGE, 0])
+        other.iterate()
+        self.board.sp.write([0])
+        self.board.iterate()
+        other.sp.write([0])
+        other.iterate()
+        self.assertEqual(self.board.analog[0].read(), 1.0)
+        self.assertEqual(other.analog[0].read(), 0.0)
+
+    def test_pin_attributes_are_fixed(self):
+        self.assertRaises(AttributeError, setattr, self.board.digital[2], 'valeu', 1)
+        self.assertRaises(AttributeError, setattr, self.board.digital_ports[0], 'pin', 1)
+
+    def test_stats(self):
+        self.assertRaises(IOError, self.board.stats)
+        self.board.enable_stats()
+        self.board.analog[0].enable_reporting()
+        self.board.sp.clear()
+        incoming = [pyfirmata.ANALOG_MESSAGE, 1, 2,
+                    5,  # a stray data byte
+                    pyfirmata.ANALOG_MESSAGE + 1, 3,  # cut off by the next message
+                    pyfirmata.REPORT_VERSION, 2, 5,
+                    pyfirmata.START_SYSEX, 0x10, 1, pyfirmata.END_SYSEX,  # unknown sysex
+                    0xB0, 1]  # unknown command
+        self.board.sp.write(incoming)
+        self.board.iterate()
+
+        stats = self.board.stats()
+        self.assertEqual(stats['bytes_in'], len(incoming))
+        self.assertEqual(stats['bytes_out'], 2)
+        self.assertEqual(stats['dropped_bytes'], 9)
+        self.assertEqual(stats['messages'], {pyfirmata.ANALOG_MESSAGE: 1,
+                                             pyfirmata.REPORT_VERSION: 1})
+        self.assertEqual(sorted(stats['handler_time']), sorted(stats['messages']))
+        self.assertEqual(stats['parse_calls'], 1)
+        self.assertTrue(stats['max_parse_time'] <= stats['parse_time'] < stats['elapsed'])
+
+        self.board.disable_stats()
+        self.assertRaises(IOError, self.board.stats)
+        self.assertFalse(hasattr(self.board._command_handlers[pyfirmata.ANALOG_MESSAGE][0],
+                                 '_untimed'))
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE, 127, 7])
+        self.board.iterate()
+        self.assertEqual(self.board.analog[0].read(), 1.0)
+
+    def count_writes(self):
+        writes = []
+        write = self.board.sp.write
+
+        def counting_write(value):
+            writes.append(bytearray(value))
+            write(value)
+        self.board.sp.write = counting_write
+        return writes
+
+    def test_batch(self):
+        writes = self.count_writes()
+        with self.board.batch():
+            self.board.digital[2].mode = pyfirmata.OUTPUT
+            with self.board.batch():
+                self.board.digital[3].mode = pyfirmata.OUTPUT
+            self.board.digital[2].write(1)
+            self.assertEqual(writes, [])
+        self.assertEqual(writes, [bytearray([0xF4, 2, 1, 0xF4, 3, 1, 0x90, 1 << 2, 0])])
+        self.assert_serial(*writes[0])
+
+    # type                command  channel    first byte            second byte
+    # ---------------------------------------------------------------------------
+    # digital I/O message   0x90   port       LSB(bits 0-6)         MSB(bits 7-13)
+    def test_write_digital(self):
+        self.board.digital[2].mode = pyfirmata.OUTPUT
+        self.board.digital[7].mode = pyfirmata.OUTPUT
+        self.board.sp.clear()
+        self.board.digital[2].write(1)
+        self.assert_serial(0x90, 1 << 2, 0)
+        self.board.digital[7].write(True)
+        self.assert_serial(0x90, 1 << 2, 1)
+        self.board.digital[2].write(0)
+        self.assert_serial(0x90, 0, 1)
+
+    def test_write_digital_only_sends_changes(self):
+        self.board.digital[2].mode = pyfirmata.OUTPUT
+        self.board.digital[2].write(1)
+        self.board.sp.clear()
+        self.board.digital[2].write(True)
+        self.board.digital[2].write(1)
+        self.assert_serial()
+
+    def test_write_digital_after_mode_change(self):
+        pin = self.board.digital[2]
+        pin.mode = pyfirmata.OUTPUT
+        self.board.digital[3].mode = pyfirmata.OUTPUT
+        pin.write(1)
+        pin.mode = pyfirmata.INPUT
+        self.board.sp.clear()
+        self.board.digital[3].write(1)
+        self.assert_serial(0x90, 1 << 3, 0)
+        # Setting the mode resets the output, like the firmware does
+        pin.mode = pyfirmata.OUTPUT
+        self.assertEqual(pin.read(), None)
+        self.board.sp.clear()
+        self.board.digital_ports[0].write()
+        self.assert_serial(0x90, 1 << 3, 0)
+        self.board.sp.clear()
+        pin.write(1)
+        self.assert_serial(0x90, 1 << 2 | 1 << 3, 0)
+
+    def test_write_same_value_in_new_mode(self):
+        sp = mockup.SimulatedSerial()
+        board = pyfirmata.Board(sp, setup_timeout=1)
+        pin = board.digital[9]
+        pin.mode = pyfirmata.OUTPUT
+        pin.write(1)
+        pin.mode = pyfirmata.PWM
+        pin.write(1.0)
+        sp.advance(0.01)
+        self.assertEqual(sp.values[9], 255)
+        # A value read as an input hasn't been written
+        pin = board.digital[7]
+        pin.mode = pyfirmata.INPUT
+        sp.set_digital(7, True)
+        sp.advance(0.01)
+        while sp.inWaiting():
+            board.iterate()
+        self.assertEqual(pin.read(), True)
+        pin.mode = pyfirmata.OUTPUT
+        pin.write(1)
+        sp.advance(0.01)
+        self.assertEqual(sp.values[7], 1)
+
+    def test_batch_threshold(self):
+        writes = self.count_writes()
+        with self.board.batch(threshold=6):
+            for i in range(2, 7):
+                self.board.digital[i].mode = pyfirmata.OUTPUT
+        self.assertEqual([len(w) for w in writes], [6, 6, 3])
+
+    def test_batch_written_on_error(self):
+        writes = self.count_writes()
+        try:
+            with self.board.batch():
+                self.board.digital[2].mode = pyfirmata.OUTPUT
+                self.board.digital[1].mode = pyfirmata.OUTPUT  # Unavailable
+        except IOError:
+            pass
+        self.assertEqual(writes, [bytearray([0xF4, 2, 1])])
+
     # Servo config
     # --------------------
     # 0  START_SYSEX (0xF0)
@@ -349,6 +718,154 @@ class TestBoardMessages(BoardBaseTest):
         self.assert_serial(*data)
 
 
+class GatedSerial(mockup.MockupSerial):
+    """
+    A serial port whose writes wait for ``gate`` to be set, like a saturated
+    link. The data of every write is kept in ``writes``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(GatedSerial, self).__init__(*args, **kwargs)
+        self.gate = threading.Event()
+        self.writing = threading.Event()
+        self.writes = []
+
+    def write(self, value):
+        self.writing.set()
+        self.gate.wait()
+        self.writes.append(bytes(value))
+
+
+class TestWriter(BoardBaseTest):
+
+    def setUp(self):
+        super(TestWriter, self).setUp()
+        self.board.sp = GatedSerial('', 57600)
+
+    def tearDown(self):
+        self.board.sp.gate.set()
+        self.board.exit()
+
+    def report(self, pin_nr):
+        """Writes a message for analog pin ``pin_nr`` and returns it."""
+        self.board.analog[pin_nr].enable_reporting()
+        return bytes(bytearray([pyfirmata.REPORT_ANALOG + pin_nr, 1]))
+
+    def start_stuck_writer(self, size, overflow):
+        """
+        Starts a writer that is stuck writing a first message, and returns
+        that message.
+        """
+        self.board.start_writer(size, overflow)
+        msg = self.report(0)
+        self.assertTrue(self.board.sp.writing.wait(1))
+        return msg
+
+    def test_writes_are_coalesced(self):
+        msgs = [self.start_stuck_writer(10, 'block')]
+        msgs += [self.report(i) for i in range(1, 4)]
+        self.board.sp.gate.set()
+        self.assertTrue(self.board.flush(1))
+        self.assertEqual(self.board.sp.writes, [msgs[0], b''.join(msgs[1:])])
+
+    def test_overflow_raise(self):
+        self.start_stuck_writer(2, 'raise')
+        self.report(1)
+        self.report(2)
+        self.assertRaises(pyfirmata.WriteQueueFullError, self.report, 3)
+
+    def test_overflow_drop_oldest(self):
+        msgs = [self.start_stuck_writer(2, 'drop-oldest')]
+        msgs += [self.report(i) for i in range(1, 4)]
+        self.assertEqual(self.board._writer.dropped, 1)
+        self.board.sp.gate.set()
+        self.board.flush(1)
+        self.assertEqual(b''.join(self.board.sp.writes), msgs[0] + msgs[2] + msgs[3])
+
+    def test_overflow_block(self):
+        msgs = [self.start_stuck_writer(1, 'block'), self.report(1)]
+        blocked = threading.Thread(target=lambda: msgs.append(self.report(2)))
+        blocked.start()
+        blocked.join(0.05)
+        self.assertTrue(blocked.is_alive())
+        self.board.sp.gate.set()
+        blocked.join(1)
+        self.board.flush(1)
+        self.assertEqual(b''.join(self.board.sp.writes), b''.join(msgs))
+
+    def test_stop_writer_writes_everything(self):
+        msgs = [self.start_stuck_writer(10, 'block'), self.report(1)]
+        self.board.sp.gate.set()
+        self.board.stop_writer()
+        self.assertEqual(b''.join(self.board.sp.writes), b''.join(msgs))
+        # Writes go to the port directly again
+        msgs.append(self.report(2))
+        self.assertEqual(self.board.sp.writes[-1], msgs[-1])
+
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.file = io.BytesIO()
+        writer = trace.TraceWriter(self.file)
+        writer.write(bytearray([pyfirmata.REPORT_VERSION, 2, 5]), 0.0)
+        # A message split over two reads
+        writer.write(bytearray([pyfirmata.REPORT_VERSION, 2]), 0.5)
+        writer.write(bytearray([6]), 0.6)
+        writer.close()
+        self.file.seek(0)
+
+    def test_read_trace(self):
+        self.assertEqual(list(trace.read_trace(self.file)), [
+            (0.0, bytearray([pyfirmata.REPORT_VERSION, 2, 5])),
+            (0.5, bytearray([pyfirmata.REPORT_VERSION, 2])),
+            (0.6, bytearray([6])),
+        ])
+        self.assertRaises(ValueError, list, trace.read_trace(io.BytesIO(b'nope')))
+
+    def test_replay(self):
+        board = pyfirmata.Board(trace.ReplaySerial(self.file, speed=None), BOARDS['arduino'],
+                                setup_timeout=0)
+        while not board.sp.finished:
+            board.iterate()
+        self.assertEqual(board.firmata_version, (2, 6))
+
+    def test_replay_paused(self):
+        board = pyfirmata.Board(trace.ReplaySerial(self.file, speed=None, paused=True),
+                                BOARDS['arduino'], setup_timeout=0)
+        self.assertEqual(board.firmata_version, None)
+        self.assertEqual(board.iterate(), 0)
+        board.sp.play()
+        while not board.sp.finished:
+            board.iterate()
+        self.assertEqual(board.firmata_version, (2, 6))
+
+    def test_replay_speed(self):
+        start = time.time()
+        board = pyfirmata.Board(trace.ReplaySerial(self.file, speed=10), BOARDS['arduino'],
+                                setup_timeout=0)
+        # Only the first record is due yet
+        self.assertEqual(board.firmata_version, (2, 5))
+        while not board.sp.finished:
+            board.iterate()
+        self.assertTrue(0.05 <= time.time() - start < 0.5)
+        self.assertEqual(board.firmata_version, (2, 6))
+
+    def test_recording(self):
+        pyfirmata.pyfirmata.serial.Serial = mockup.MockupSerial
+        board = pyfirmata.Board('', BOARDS['arduino'], setup_timeout=0)
+        recorded = io.BytesIO()
+        board.start_recording(recorded)
+        board.sp.write([pyfirmata.REPORT_VERSION, 2, 5])
+        board.iterate()
+        board.stop_recording()
+        self.assertTrue(isinstance(board.sp, mockup.MockupSerial))
+        recorded.seek(0)
+        records = list(trace.read_trace(recorded))
+        self.assertEqual([data for timestamp, data in records],
+                         [bytearray([pyfirmata.REPORT_VERSION, 2, 5])])
+
+
 class TestBoardLayout(BoardBaseTest):
 
     def test_layout_arduino(self):
@@ -389,6 +906,454 @@ class TestBoardLayout(BoardBaseTest):
         pyfirmata.serial.Serial = serial.Serial
 
 
+class BootingSerial(mockup.MockupSerial):
+    """
+    A serial port to a board that only answers the third version query, like
+    a board that is still resetting.
+    """
+    queries = 0
+
+    def write(self, value):
+        if bytearray(value)[:1] == bytearray([pyfirmata.REPORT_VERSION]):
+            self.queries += 1
+            if self.queries == 3:
+                self.extend([pyfirmata.REPORT_VERSION, 2, 5])
+
+
+class SilentSerial(mockup.MockupSerial):
+    """A serial port without a board, or one without Firmata."""
+
+    def write(self, value):
+        pass
+
+
+class FirmwareSerial(mockup.MockupSerial):
+    """
+    A serial port to a board that answers the queries of the setup, with the
+    modes and resolutions of each pin in ``capabilities``.
+    """
+    capabilities = [[0, 1, 1, 1], [0, 1, 1, 1, 3, 8], [0, 1, 1, 1, 2, 10], [0, 1, 1, 1, 2, 10]]
+    capability_queries = 0
+    # The reply to the analog mapping query, None to not answer it
+    analog_mapping = None
+
+    def write(self, value):
+        value = bytearray(value)
+        if value[:1] == bytearray([pyfirmata.REPORT_VERSION]):
+            self.extend([pyfirmata.REPORT_VERSION, 2, 5])
+        elif value[:2] == bytearray([pyfirmata.START_SYSEX, pyfirmata.QUERY_FIRMWARE]):
+            self.extend([pyfirmata.START_SYSEX, pyfirmata.REPORT_FIRMWARE, 2, 5])
+            self.extend(str_to_two_byte_iter('Test'))
+            self.append(pyfirmata.END_SYSEX)
+        elif value[:2] == bytearray([pyfirmata.START_SYSEX, pyfirmata.CAPABILITY_QUERY]):
+            self.capability_queries += 1
+            self.extend([pyfirmata.START_SYSEX, pyfirmata.CAPABILITY_RESPONSE])
+            for modes in self.capabilities:
+                self.extend(modes + [0x7F])
+            self.append(pyfirmata.END_SYSEX)
+        elif value[:2] == bytearray([pyfirmata.START_SYSEX, pyfirmata.ANALOG_MAPPING_QUERY]):
+            if self.analog_mapping is None:
+                return
+            self.extend([pyfirmata.START_SYSEX, pyfirmata.ANALOG_MAPPING_RESPONSE])
+            self.extend(self.analog_mapping)
+            self.append(pyfirmata.END_SYSEX)
+
+
+class MappedFirmwareSerial(FirmwareSerial):
+    """
+    A :class:`FirmwareSerial` with an analog pin between the digital ones,
+    and an analog mapping to tell.
+    """
+    capabilities = [[], [0, 1, 1, 1, 2, 10], [0, 1, 1, 1], [0, 1, 1, 1, 2, 10],
+                    [0, 1, 1, 1, 2, 10]]
+    analog_mapping = [127, 2, 127, 0, 1]
+
+
+class HighResolutionSerial(FirmwareSerial):
+    """
+    A :class:`FirmwareSerial` with 12-bit analog inputs, and 10-bit and 16-bit
+    PWM.
+    """
+    capabilities = [[0, 1, 1, 1], [0, 1, 1, 1, 3, 10, 6, 1], [0, 1, 1, 1, 3, 16],
+                    [0, 1, 1, 1, 2, 12], [0, 1, 1, 1, 2, 12]]
+
+
+def open_test_serial(port, *args, **kwargs):
+    """Opens a mockup serial port that acts as its name says."""
+    if 'missing' in port:
+        raise serial.SerialException("could not open port {0}".format(port))
+    serial_class = SilentSerial if 'silent' in port else FirmwareSerial
+    return serial_class(port, *args, **kwargs)
+
+
+class TestBoardSetup(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        pyfirmata.pyfirmata.serial.Serial = REAL_SERIAL
+        shutil.rmtree(self.cache_dir)
+
+    def test_waits_for_firmware(self):
+        pyfirmata.pyfirmata.serial.Serial = BootingSerial
+        board = pyfirmata.Board('', BOARDS['arduino'], setup_timeout=5)
+        self.assertEqual(board.sp.queries, 3)
+        self.assertEqual(board.firmata_version, (2, 5))
+
+    def test_no_firmata(self):
+        pyfirmata.pyfirmata.serial.Serial = SilentSerial
+        self.assertRaises(IOError, pyfirmata.Board, '', BOARDS['arduino'], setup_timeout=0.05)
+
+    def test_auto_setup(self):
+        pyfirmata.pyfirmata.serial.Serial = FirmwareSerial
+        board = pyfirmata.Board('', setup_timeout=1)
+        self.assertEqual(len(board.digital), 2)
+        self.assertEqual(len(board.analog), 2)
+
+    def test_analog_mapping(self):
+        pyfirmata.pyfirmata.serial.Serial = MappedFirmwareSerial
+        board = pyfirmata.Board('', setup_timeout=1)
+        self.assertEqual(len(board.digital), 3)
+        self.assertEqual(board.analog_pins, {0: 3, 1: 4, 2: 1})
+        self.assertEqual(board.analog_channels, {1: 2, 3: 0, 4: 1})
+        writes = []
+        board.sp.write = writes.append
+        pin = board.get_pin('a:2:i')
+        pin.mode = pyfirmata.INPUT
+        self.assertEqual(writes[-2:], [bytearray([pyfirmata.SET_PIN_MODE, 1, pyfirmata.INPUT]),
+                                       bytearray([pyfirmata.REPORT_ANALOG + 2, 1])])
+        board._parse([pyfirmata.ANALOG_MESSAGE + 2, 0x7F, 0x07])
+        self.assertEqual(pin.read(), 1.0)
+        self.assertEqual(board.analog[0].read(), None)
+
+    def test_resolutions(self):
+        pyfirmata.pyfirmata.serial.Serial = HighResolutionSerial
+        board = pyfirmata.Board('', setup_timeout=1)
+        self.assertEqual(board.capabilities[1], {pyfirmata.INPUT: 1, pyfirmata.OUTPUT: 1,
+                                                 pyfirmata.PWM: 10, pyfirmata.I2C: 1})
+        self.assertEqual(board.resolution(3, pyfirmata.ANALOG), 12)
+        self.assertEqual(board.resolution(0, pyfirmata.PWM), None)
+        board.analog[0].enable_reporting()
+        board._parse([pyfirmata.ANALOG_MESSAGE, 0x7F, 0x1F])
+        self.assertEqual(board.analog[0].read(), 1.0)
+        writes = []
+        board.sp.write = writes.append
+        board.get_pin('d:1:p').write(1.0)
+        self.assertEqual(writes[-1], bytearray([pyfirmata.ANALOG_MESSAGE + 1, 0x7F, 0x07]))
+        # Too much for an analog message
+        board.get_pin('d:2:p').write(1.0)
+        self.assertEqual(writes[-1], bytearray([pyfirmata.START_SYSEX, pyfirmata.EXTENDED_ANALOG,
+                                                2, 0x7F, 0x7F, 0x03, pyfirmata.END_SYSEX]))
+
+    def test_resolutions_missing_from_capabilities(self):
+        layout = util.pin_list_to_board_dict([[0, 1, 1, 1, 0x7F], [0, 1, 1, 1, 2, 10, 0x7F],
+                                              [0, 1, 1, 1, 0x7F]])
+        layout['pwm'] = (1,)
+        board = mockup.MockupBoard('test', layout)
+        self.assertEqual(board.analog[0]._max_value, 1023)
+        self.assertEqual(board.digital[1]._max_value, 255)
+
+    def test_discover_boards(self):
+        pyfirmata.pyfirmata.serial.Serial = open_test_serial
+        ports = ['/dev/board1', '/dev/silent1', '/dev/missing', '/dev/silent2', '/dev/board2',
+                 '/dev/silent3']
+        start = time.time()
+        boards = util.discover_boards(ports=ports, setup_timeout=0.3)
+        # The silent ports time out at the same time
+        self.assertTrue(time.time() - start < 0.6)
+        self.assertEqual([board.sp.port for board in boards], ['/dev/board1', '/dev/board2'])
+        self.assertEqual(boards[0].firmware, 'Test')
+        self.assertEqual(boards[0].firmware_version, (2, 5))
+        self.assertEqual(len(boards[0].analog), 2)
+
+    def test_get_the_board(self):
+        pyfirmata.pyfirmata.serial.Serial = open_test_serial
+        self.addCleanup(setattr, pyfirmata.pyfirmata, 'BOARD_SETUP_WAIT_TIME',
+                        pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME)
+        pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0.3
+        base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_dir)
+        for device in ('tty.usbserial-silent', 'tty.usbserial-1', 'ttyS0'):
+            open(os.path.join(base_dir, device), 'w').close()
+        board = util.get_the_board(BOARDS['arduino'], base_dir, 'tty.usbserial')
+        self.assertEqual(board.sp.port, os.path.join(base_dir, 'tty.usbserial-1'))
+        self.assertEqual(len(board.analog), 6)
+
+        open(os.path.join(base_dir, 'tty.usbserial-2'), 'w').close()
+        self.assertRaises(IOError, util.get_the_board, BOARDS['arduino'], base_dir,
+                          'tty.usbserial')
+
+    def test_layout_cache(self):
+        pyfirmata.pyfirmata.serial.Serial = FirmwareSerial
+        cache = util.LayoutCache(self.cache_dir)
+        board = pyfirmata.Board('/dev/test', setup_timeout=1, layout_cache=cache)
+        key = cache.key('/dev/test', 'Test', (2, 5))
+        self.assertEqual(cache.get(key), board._layout)
+
+        # The next board is set up from the cache, before the reply to its
+        # capability query is handled
+        board = pyfirmata.Board('/dev/test', setup_timeout=1, layout_cache=cache)
+        self.assertEqual(board.sp.capability_queries, 1)
+        self.assertEqual(len(board.digital), 2)
+
+        board.invalidate_layout_cache()
+        self.assertEqual(cache.get(key), None)
+
+    def test_layout_cache_without_setup_wait(self):
+        cache = util.LayoutCache(self.cache_dir)
+        start = time.time()
+        board = pyfirmata.Board(mockup.SimulatedSerial(), setup_timeout=0, layout_cache=cache)
+        # The firmware is asked for, not waited for until the query times out
+        self.assertTrue(time.time() - start < 0.5)
+        key = cache.key('simulated', 'StandardFirmata.ino', (2, 5))
+        self.assertEqual(cache.get(key), board._layout)
+        board = pyfirmata.Board(mockup.SimulatedSerial(), setup_timeout=0, layout_cache=cache)
+        self.assertEqual(len(board.digital), 14)
+
+    def test_layout_cache_outdated(self):
+        pyfirmata.pyfirmata.serial.Serial = FirmwareSerial
+        cache = util.LayoutCache(self.cache_dir)
+        key = cache.key('/dev/test', 'Test', (2, 5))
+        pyfirmata.Board('/dev/test', setup_timeout=1, layout_cache=cache)
+
+        class UpdatedFirmwareSerial(FirmwareSerial):
+            capabilities = FirmwareSerial.capabilities + [[0, 1, 1, 1, 2, 10]]
+        pyfirmata.pyfirmata.serial.Serial = UpdatedFirmwareSerial
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            board = pyfirmata.Board('/dev/test', setup_timeout=1, layout_cache=cache)
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(len(board.analog), 2)
+        self.assertEqual(len(cache.get(key)['analog']), 3)
+
+
+@unittest.skipUnless(hasattr(os, 'openpty'), "needs a pseudo terminal")
+class TestIterator(unittest.TestCase):
+    """Runs the Iterator on a real serial port, the slave end of a pty."""
+
+    def setUp(self):
+        self.master, self.slave = os.openpty()
+        pyfirmata.pyfirmata.serial.Serial = REAL_SERIAL
+        self.board = pyfirmata.Board(os.ttyname(self.slave), BOARDS['arduino'],
+                                     setup_timeout=0)
+        self.it = util.Iterator(self.board)
+        self.it.start()
+
+    def tearDown(self):
+        self.it.stop()
+        self.it.join()
+        self.board.exit()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def wait_for(self, condition, timeout=2):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.001)
+        return condition()
+
+    def test_handles_incoming_messages(self):
+        pin = self.board.analog[0]
+        pin.reporting = True
+        os.write(self.master, bytes(bytearray([pyfirmata.ANALOG_MESSAGE, 127, 7])))
+        self.assertTrue(self.wait_for(lambda: pin.value == 1.0))
+
+    def test_stop_wakes_blocked_reader(self):
+        time.sleep(0.01)  # let it block in the read
+        self.it.stop()
+        self.it.join(1)
+        self.assertFalse(self.it.is_alive())
+
+
+@unittest.skipUnless(hasattr(os, 'openpty'), "needs a pseudo terminal")
+class TestBoardGroup(unittest.TestCase):
+    """Runs a BoardGroup on a few boards on ptys."""
+
+    def setUp(self):
+        pyfirmata.pyfirmata.serial.Serial = REAL_SERIAL
+        self.ptys = [os.openpty() for i in range(3)]
+        self.boards = [pyfirmata.Board(os.ttyname(slave), BOARDS['arduino'], setup_timeout=0)
+                       for master, slave in self.ptys]
+        self.group = util.BoardGroup(self.boards)
+        self.group.start()
+
+    def tearDown(self):
+        self.group.stop()
+        self.group.join()
+        for board in self.boards:
+            board.exit()
+        for master, slave in self.ptys:
+            os.close(master)
+            os.close(slave)
+
+    def wait_for(self, condition, timeout=2):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.001)
+        return condition()
+
+    def send_version(self, master):
+        os.write(master, bytes(bytearray([pyfirmata.REPORT_VERSION, 2, 5])))
+
+    def test_handles_all_boards(self):
+        for master, slave in self.ptys:
+            self.send_version(master)
+        self.assertTrue(self.wait_for(
+            lambda: all(board.firmata_version == (2, 5) for board in self.boards)))
+
+    def test_remove(self):
+        self.group.remove(self.boards[0])
+        self.assertTrue(self.wait_for(lambda: self.boards[0] not in self.group._boards))
+        self.assertEqual(self.group.boards, set(self.boards[1:]))
+        self.send_version(self.ptys[0][0])
+        self.send_version(self.ptys[1][0])
+        self.assertTrue(self.wait_for(lambda: self.boards[1].firmata_version == (2, 5)))
+        self.assertEqual(self.boards[0].firmata_version, None)
+        self.assertEqual(self.boards[0].bytes_available(), 3)
+
+    def test_stop(self):
+        self.group.stop()
+        self.group.join(1)
+        self.assertFalse(self.group.is_alive())
+
+    def test_add_closed_port(self):
+        board = self.boards[0]
+        self.assertTrue(self.wait_for(lambda: board in self.group._boards))
+        self.group.remove(board)
+        self.assertTrue(self.wait_for(lambda: board not in self.group._boards))
+        board.sp.close()
+        self.assertRaises(serial.SerialException, self.group.add, board)
+        self.send_version(self.ptys[1][0])
+        self.assertTrue(self.wait_for(lambda: self.boards[1].firmata_version == (2, 5)))
+
+    def test_failing_board(self):
+        def fail(major, minor):
+            raise RuntimeError("bug in a handler")
+        self.boards[0].add_cmd_handler(pyfirmata.REPORT_VERSION, fail)
+        self.assertTrue(self.wait_for(lambda: self.boards[0] in self.group._boards))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.send_version(self.ptys[0][0])
+            self.assertTrue(self.wait_for(lambda: self.boards[0] not in self.group._boards))
+        self.assertTrue('bug in a handler' in str(caught[0].message))
+        self.assertTrue(self.group.is_alive())
+        self.send_version(self.ptys[1][0])
+        self.assertTrue(self.wait_for(lambda: self.boards[1].firmata_version == (2, 5)))
+
+
+@unittest.skipUnless(hasattr(os, 'openpty'), "needs a pseudo terminal")
+class TestAsyncBoard(unittest.TestCase):
+    """
+    Runs an AsyncBoard on the slave end of a pty, with the test playing the
+    firmware on the master end.
+    """
+
+    def setUp(self):
+        self.master, self.slave = os.openpty()
+        self.received = bytearray()
+        pyfirmata.pyfirmata.serial.Serial = REAL_SERIAL
+
+    def tearDown(self):
+        if self.master is not None:
+            os.close(self.master)
+        os.close(self.slave)
+
+    def firmware_read_ready(self):
+        data = os.read(self.master, 1024)
+        self.received += data
+        if pyfirmata.REPORT_VERSION in bytearray(data):
+            os.write(self.master, bytes(bytearray([pyfirmata.REPORT_VERSION, 2, 5])))
+
+    def run_board(self, test):
+        async def run():
+            loop = asyncio.get_event_loop()
+            loop.add_reader(self.master, self.firmware_read_ready)
+            board = await aio.AsyncBoard.open(os.ttyname(self.slave), BOARDS['arduino'],
+                                              setup_timeout=1)
+            try:
+                await asyncio.wait_for(test(board), 2)
+            finally:
+                board.exit()
+                if self.master is not None:
+                    loop.remove_reader(self.master)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    async def received_ends_with(self, *data):
+        while not self.received.endswith(bytearray(data)):
+            await asyncio.sleep(0.001)
+
+    def test_startup(self):
+        async def test(board):
+            self.assertEqual(board.firmata_version, (2, 5))
+            self.assertEqual(len(board.digital), len(BOARDS['arduino']['digital']))
+        self.run_board(test)
+
+    def test_read(self):
+        async def test(board):
+            pin = await board.get_pin('a:0:i')
+            await self.received_ends_with(pyfirmata.REPORT_ANALOG, 1)
+            os.write(self.master, bytes(bytearray([pyfirmata.ANALOG_MESSAGE, 127, 7])))
+            self.assertEqual(await pin.read(), 1.0)
+        self.run_board(test)
+
+    def test_read_raw(self):
+        async def test(board):
+            pin = await board.get_pin('a:0:i')
+            pin.enable_raw()
+            await self.received_ends_with(pyfirmata.REPORT_ANALOG, 1)
+            read = asyncio.ensure_future(pin.read())
+            await asyncio.sleep(0.01)
+            self.assertFalse(read.done())
+            os.write(self.master, bytes(bytearray([pyfirmata.ANALOG_MESSAGE, 127, 7])))
+            self.assertEqual(await read, 1023)
+            self.assertEqual(pin.value, None)
+        self.run_board(test)
+
+    def test_write(self):
+        async def test(board):
+            pin = await board.get_pin('d:13:o')
+            await pin.write(1)
+            await self.received_ends_with(pyfirmata.DIGITAL_MESSAGE + 1, 1 << 5, 0)
+        self.run_board(test)
+
+    def test_no_firmware(self):
+        async def test():
+            loop = asyncio.get_event_loop()
+            board = aio.AsyncBoard(os.ttyname(self.slave), BOARDS['arduino'])
+            with self.assertRaises(IOError):
+                await board.start(setup_timeout=0.1)
+            self.assertFalse(board.sp.sp.is_open)
+            self.assertFalse(loop.remove_reader(board.sp._fd))
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(test())
+        finally:
+            loop.close()
+
+    def test_connection_lost(self):
+        async def test(board):
+            pin = await board.get_pin('a:0:i')
+            read = asyncio.ensure_future(pin.read())
+            await asyncio.sleep(0.01)
+            # Unplug the board
+            asyncio.get_event_loop().remove_reader(self.master)
+            os.close(self.master)
+            self.master = None
+            with self.assertRaises(IOError):
+                await read
+            with self.assertRaises(IOError):
+                await board.drain()
+            with self.assertRaises(IOError):
+                await pin.read()
+            self.assertFalse(board.sp.sp.is_open)
+        self.run_board(test)
+
+
 class TestMockupSerial(unittest.TestCase):
 
     def setUp(self):
@@ -414,6 +1379,208 @@ class TestMockupSerial(unittest.TestCase):
         self.assertEqual(self.s.read(), bytearray())
 
 
+class TestSimulatedSerial(unittest.TestCase):
+
+    def setUp(self):
+        self.sp = mockup.SimulatedSerial()
+        self.board = pyfirmata.Board(self.sp, setup_timeout=1)
+        self.messages = []
+
+    def read_all(self):
+        while self.sp.inWaiting():
+            self.board.iterate()
+
+    def test_setup(self):
+        self.assertEqual(self.board.firmata_version, (2, 5))
+        self.assertEqual(self.board.firmware, 'StandardFirmata.ino')
+        self.assertEqual(len(self.board.digital), len(BOARDS['arduino']['digital']))
+        self.assertEqual(len(self.board.analog), len(BOARDS['arduino']['analog']))
+        self.assertTrue(self.board.digital[3].PWM_CAPABLE)
+        self.assertFalse(self.board.digital[2].PWM_CAPABLE)
+        # Much less than the time setting up a real board takes
+        self.assertTrue(self.sp.now < 0.1)
+
+    def test_analog_reporting(self):
+        self.board.enable_stats()
+        self.sp.set_analog(0, 512)
+        self.sp.set_analog(1, lambda t: 1000 * t)
+        self.board.analog[0].enable_reporting()
+        self.board.analog[1].enable_reporting()
+        start = self.sp.now
+        self.sp.advance(0.1)
+        self.read_all()
+        self.assertEqual(self.board.analog[0].read(), 0.5005)
+        self.assertTrue(0 < self.board.analog[1].read() < 0.2)
+        # A report every 19 ms, for both channels
+        reports = self.board.stats()['messages'][pyfirmata.ANALOG_MESSAGE]
+        self.assertTrue(9 <= reports <= 12)
+        self.board.set_sampling_interval(10)
+        self.sp.advance(0.1)
+        self.read_all()
+        reports = self.board.stats()['messages'][pyfirmata.ANALOG_MESSAGE] - reports
+        self.assertTrue(19 <= reports <= 21)
+        self.assertTrue(self.sp.now - start >= 0.2)
+
+    def test_bandwidth(self):
+        sp = mockup.SimulatedSerial(baudrate=1200)
+        board = pyfirmata.Board(sp, setup_timeout=1)
+        # 10 bits a byte
+        self.assertTrue(sp.now > 100 * 10 / 1200)
+        for channel in range(6):
+            board.analog[channel].enable_reporting()
+        board.set_sampling_interval(1)
+        sp.advance(1)
+        data = bytearray()
+        while sp.inWaiting():
+            data += sp.read(sp.inWaiting())
+        # Sampling slows down to what the port can take
+        self.assertTrue(90 <= len(data) <= 130)
+
+    def test_extended_analog(self):
+        layout = dict(BOARDS['arduino_mega'], pwm=tuple(range(2, 14)) + (44, 45, 46))
+        sp = mockup.SimulatedSerial(layout)
+        board = pyfirmata.Board(sp, setup_timeout=1)
+        board.get_pin('d:44:p').write(1.0)
+        board.get_pin('d:20:s').write(90)
+        board.get_pin('d:9:p').write(0.5)
+        sp.advance(0.01)
+        self.assertEqual(sp.values[44], 255)
+        self.assertEqual(sp.values[20], 90)
+        self.assertEqual(sp.modes[20], pyfirmata.SERVO)
+        self.assertEqual(sp.values[9], 128)
+
+    def test_digital(self):
+        self.board.digital[13].write(1)
+        self.sp.advance(0.01)
+        self.assertEqual(self.sp.values[13], 1)
+        self.assertEqual(self.sp.modes[13], pyfirmata.OUTPUT)
+        pin = self.board.get_pin('d:2:i')
+        pin.enable_reporting()
+        self.sp.advance(0.01)
+        self.sp.set_digital(2, True)
+        self.sp.advance(0.01)
+        self.read_all()
+        self.assertEqual(pin.read(), True)
+        self.board.get_pin('d:3:p').write(0.5)
+        self.sp.advance(0.01)
+        self.assertEqual(self.sp.values[3], 128)
+
+    def test_digital_after_mode_change(self):
+        pin = self.board.digital[3]
+        for mode in pyfirmata.PWM, pyfirmata.INPUT, pyfirmata.SERVO:
+            pin.mode = pyfirmata.OUTPUT
+            pin.write(1)
+            self.sp.advance(0.01)
+            self.assertEqual(self.sp.values[3], 1)
+            pin.mode = mode
+            self.sp.advance(0.01)
+            self.assertEqual(self.sp.values[3], 0)
+
+    def test_queries(self):
+        def record(*args):
+            self.messages.append(args)
+        self.board.add_cmd_handler(pyfirmata.PIN_STATE_RESPONSE, record)
+        self.board.add_cmd_handler(pyfirmata.ANALOG_MAPPING_RESPONSE, record)
+        self.board.digital[13].write(1)
+        self.board.send_sysex(pyfirmata.PIN_STATE_QUERY, [13])
+        self.board.send_sysex(pyfirmata.ANALOG_MAPPING_QUERY, [])
+        self.read_all()
+        self.assertEqual(self.messages, [
+            (13, pyfirmata.OUTPUT, 1),
+            tuple([127] * 14 + list(range(6))),
+        ])
+
+
+class TestI2C(unittest.TestCase):
+
+    def setUp(self):
+        self.sp = mockup.SimulatedSerial()
+        self.board = pyfirmata.Board(self.sp, setup_timeout=1)
+        self.board.i2c_config()
+        self.registers = self.sp.add_i2c_device(0x48, bytearray(range(256)))
+
+    def read_all(self):
+        while self.sp.inWaiting():
+            self.board.iterate()
+
+    def test_i2c_write(self):
+        self.board.i2c_write(0x48, [0x10, 200, 201])
+        self.sp.advance(0.01)
+        self.assertEqual(self.registers[0x10:0x13], bytearray([200, 201, 0x12]))
+        self.assertRaises(ValueError, self.board.i2c_write, 0x400, [0])
+
+    def test_i2c_read(self):
+        first = self.board.i2c_read(0x48, 0x20, 2)
+        second = self.board.i2c_read(0x48, 0x20, 2)
+        self.assertFalse(first.done())
+        self.read_all()
+        self.assertEqual(first.result(0), bytearray([0x20, 0x21]))
+        self.assertEqual(second.result(0), bytearray([0x20, 0x21]))
+        self.assertEqual(self.board._i2c_reads, {})
+        # Without a register
+        future = self.board.i2c_read(0x48, count=1)
+        self.read_all()
+        self.assertEqual(future.result(0), bytearray([0]))
+
+    def test_i2c_read_many(self):
+        writes = []
+        write = self.sp.write
+        self.sp.write = lambda data: writes.append(data) or write(data)
+        reads = [(0x30, 2), (0x32, 1), (0x40, 1)]
+        futures = self.board.i2c_read_many(0x48, reads)
+        # Two requests, written in one go
+        self.assertEqual([len(data) for data in writes], [2 * 9])
+        self.read_all()
+        self.assertEqual([future.result(0) for future in futures],
+                         [bytearray([0x30, 0x31]), bytearray([0x32]), bytearray([0x40])])
+
+    def test_i2c_read_continuous(self):
+        replies = []
+        buffers = set()
+
+        def callback(data):
+            replies.append(bytes(data))
+            buffers.add(id(data))
+        self.board.i2c_read_continuous(0x48, 0x01, 3, callback)
+        self.assertRaises(ValueError, self.board.i2c_read_continuous, 0x48, 0x01, 2, callback)
+        self.sp.advance(0.05)
+        self.read_all()
+        self.assertTrue(2 <= len(replies) <= 3)
+        self.assertEqual(replies[0], bytes([1, 2, 3]))
+        self.registers[1] = 99
+        self.sp.advance(0.02)
+        self.read_all()
+        self.assertEqual(replies[-1], bytes([99, 2, 3]))
+        self.assertEqual(len(buffers), 1)
+        count = len(replies)
+        self.board.i2c_stop_reading(0x48)
+        self.sp.advance(0.1)
+        self.read_all()
+        self.assertEqual(len(replies), count)
+
+    def test_cancelled_read(self):
+        cancelled = self.board.i2c_read(0x48, 3, 2)
+        self.assertTrue(cancelled.cancel())
+        future = self.board.i2c_read(0x48, 3, 2)
+        self.read_all()
+        self.assertEqual(future.result(0), bytearray([3, 4]))
+
+    def test_short_read(self):
+        self.sp.add_i2c_device(0x50, bytearray([1, 2, 3, 4]))
+        future = self.board.i2c_read(0x50, 2, 4)
+        replies = []
+        self.board.i2c_read_continuous(0x50, 3, 2, lambda data: replies.append(bytes(data)))
+        self.sp.advance(0.05)
+        self.read_all()
+        self.assertEqual(future.result(0), bytearray([3, 4]))
+        self.assertEqual(replies[0], bytes([4]))
+
+    def test_pending_reads_are_cancelled_on_exit(self):
+        future = self.board.i2c_read(0x48, 0, 1)
+        self.board.exit()
+        self.assertTrue(future.cancelled())
+
+
 class TestMockupBoardLayout(TestBoardLayout, TestBoardMessages):
     """
     TestMockupBoardLayout is subclassed from TestBoardLayout and
@@ -503,6 +1670,57 @@ class UtilTests(unittest.TestCase):
             itr.append(0)
         self.assertEqual(itr, str_to_two_byte_iter(string))
 
+    def test_scale_table(self):
+        table = pyfirmata.pyfirmata.scale_table(1023)
+        self.assertTrue(table is pyfirmata.pyfirmata.scale_table(1023))
+        self.assertEqual(list(table), [round(float(raw) / 1023, 4) for raw in range(1024)])
+
+    def test_parse_capability_response(self):
+        data = [0x7F, 0, 1, 1, 1, 3, 8, 0x7F, 2, 12, 6, 1, 0x7F]
+        self.assertEqual(util.parse_capability_response(data),
+                         [{}, {0: 1, 1: 1, 3: 8}, {2: 12, 6: 1}])
+        layout = util.capabilities_to_board_dict(util.parse_capability_response(data))
+        self.assertEqual(layout['capabilities'], ((), (0, 1, 1, 1, 3, 8), (2, 12, 6, 1)))
+        self.assertEqual(layout['digital'], (0, 1))
+        self.assertEqual(layout['analog'], (0,))
+        self.assertEqual(layout['pwm'], (1,))
+
+    def test_pin_list_to_board_dict_with_analog_mapping(self):
+        pins = [[], [0, 1, 1, 1, 3, 8], [0, 1, 1, 1, 2, 10], [0, 1, 1, 1, 2, 10]]
+        layout = util.pin_list_to_board_dict([pin + [0x7F] for pin in pins], [127, 127, 1, 0])
+        self.assertEqual(layout['digital'], (0, 1))
+        self.assertEqual(layout['analog'], (0, 1))
+        self.assertEqual(layout['analog_pins'], (3, 2))
+        self.assertEqual(layout['pwm'], (1,))
+        self.assertEqual(layout['disabled'], (0,))
+
+    def test_pin_list_to_board_dict_with_analog_pwm(self):
+        pins = [[0, 1, 1, 1, 3, 10]] * 4 + [[0, 1, 1, 1, 2, 12, 3, 10]]
+        for mapping in None, [127] * 4 + [0]:
+            layout = util.pin_list_to_board_dict([pin + [0x7F] for pin in pins], mapping)
+            self.assertEqual(layout['digital'], (0, 1, 2, 3))
+            self.assertEqual(layout['pwm'], (0, 1, 2, 3))
+            board = mockup.MockupBoard('test', layout)
+            self.assertTrue(board.digital[3].PWM_CAPABLE)
+            self.assertEqual(len(board.analog), 1)
+        # Layouts that were cached before have the analog pin in 'pwm'
+        mockup.MockupBoard('test', dict(layout, pwm=(0, 1, 2, 3, 4)))
+
+    def test_sample_history(self):
+        history = SampleHistory(4)
+        self.assertEqual(len(history), 0)
+        self.assertEqual([list(a) for a in history.last()], [[], []])
+        for i in range(6):
+            history.append(i * 0.5, i)
+        self.assertEqual(len(history), 4)
+        self.assertEqual([list(a) for a in history.last()], [[1.0, 1.5, 2.0, 2.5], [2, 3, 4, 5]])
+        self.assertEqual(list(history.last(3)[1]), [3, 4, 5])
+        self.assertEqual(list(history.since(1.6)[1]), [4, 5])
+        self.assertEqual(list(history.since(0)[1]), [2, 3, 4, 5])
+        self.assertEqual(list(history.since(3)[1]), [])
+        history.clear()
+        self.assertEqual(len(history), 0)
+
     def test_break_to_bytes(self):
         self.assertEqual(break_to_bytes(200), (200,))
         self.assertEqual(break_to_bytes(800), (200, 4))